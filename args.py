@@ -18,6 +18,26 @@ def add_common_setup_args(parser):
       type=int,
       default=16,
       help='Max number of chars to keep from a word')
+  parser.add_argument(
+      '--para_limit',
+      type=int,
+      default=400,
+      help='Max number of words in a paragraph')
+  parser.add_argument(
+      '--ques_limit',
+      type=int,
+      default=50,
+      help='Max number of words to keep from a question')
+  parser.add_argument(
+      '--test_para_limit',
+      type=int,
+      default=1000,
+      help='Max number of words in a paragraph at test time')
+  parser.add_argument(
+      '--test_ques_limit',
+      type=int,
+      default=100,
+      help='Max number of words in a question at test time')
   parser.add_argument(
       '--include_test_examples',
       type=lambda s: s.lower().startswith('t'),
@@ -56,6 +76,15 @@ def get_setup_bert_args():
       default=None,
       type=str,
       help="SQuAD json for test. E.g. test-v.2.0.json")
+
+  add_bert_feature_args(parser)
+
+  args = parser.parse_args()
+  return args
+
+
+def add_bert_feature_args(parser):
+  """Add arguments for converting SQuAD examples to BERT features."""
   parser.add_argument(
       '--do_lower_case',
       type=lambda s: s.lower().startswith('t'),
@@ -84,9 +113,6 @@ def get_setup_bert_args():
       "The maximum number of tokens for the question. Questions longer than this will "
       "be truncated to this length.")
 
-  args = parser.parse_args()
-  return args
-
 
 def get_setup_args():
   """Get arguments needed in setup.py."""
@@ -94,7 +120,15 @@ def get_setup_args():
 
   add_common_args(parser)
   add_common_setup_args(parser)
+  add_setup_args(parser)
+
+  args = parser.parse_args()
+
+  return args
 
+
+def add_setup_args(parser):
+  """Add arguments for pre-processing SQuAD and GloVe in setup.py."""
   parser.add_argument(
       '--train_url',
       type=str,
@@ -136,10 +170,6 @@ def get_setup_args():
       default=2196017,
       help='Number of GloVe vectors')
 
-  args = parser.parse_args()
-
-  return args
-
 
 def get_train_args():
   """Get arguments needed in train.py."""
@@ -161,6 +191,18 @@ def get_train_args():
       type=int,
       default=30,
       help='Number of epochs for which to train. Negative means forever.')
+  parser.add_argument(
+      '--max_tokens',
+      type=int,
+      default=0,
+      help='Padded token budget per GPU for each batch. If nonzero, batches \
+                              are cut by (batch size x max. context length) \
+                              instead of --batch_size.')
+  parser.add_argument(
+      '--max_tokens_with_questions',
+      type=lambda s: s.lower().startswith('t'),
+      default=False,
+      help='Count padded question tokens towards --max_tokens.')
   parser.add_argument(
       '--drop_prob',
       type=float,
@@ -189,6 +231,28 @@ def get_train_args():
       type=float,
       default=0.999,
       help='Decay rate for exponential moving average of parameters.')
+  parser.add_argument(
+      '--perf_window',
+      type=int,
+      default=0,
+      help='Number of steps over which to aggregate per-phase timings and '
+      'throughput for TensorBoard. 0 disables the instrumentation.')
+  parser.add_argument(
+      '--async_eval',
+      type=lambda s: s.lower().startswith('t'),
+      default=False,
+      help='Evaluate in a separate process while training continues.')
+  parser.add_argument(
+      '--eval_device',
+      type=str,
+      default='cpu',
+      help='Device for the evaluation process when using --async_eval.')
+  parser.add_argument(
+      '--max_pending_evals',
+      type=int,
+      default=1,
+      help='Max. number of snapshots waiting for the evaluation process. \
+                              Training waits for a free slot when full.')
   parser.add_argument(
       '--num_train_samples',
       type=int,
@@ -201,6 +265,44 @@ def get_train_args():
       default=None,
       help='The number of dev samples from the original dev dataset to use.')
 
+  parser.add_argument(
+      '--benchmark',
+      type=lambda s: s.lower().startswith('t'),
+      default=False,
+      help='Measure training throughput on synthetic batches instead of \
+                              training. Skips data loading, TensorBoard, \
+                              evaluation and checkpoints.')
+  parser.add_argument(
+      '--bench_warmup_steps',
+      type=int,
+      default=10,
+      help='Number of untimed steps in benchmark mode.')
+  parser.add_argument(
+      '--bench_steps',
+      type=int,
+      default=50,
+      help='Number of timed steps in benchmark mode.')
+  parser.add_argument(
+      '--bench_num_batches',
+      type=int,
+      default=20,
+      help='Number of distinct synthetic batches to cycle through.')
+  parser.add_argument(
+      '--bench_vocab_size',
+      type=int,
+      default=88714,
+      help='Number of rows in the synthetic word embedding matrix.')
+  parser.add_argument(
+      '--bench_para_limit',
+      type=int,
+      default=400,
+      help='Max number of words in a synthetic paragraph.')
+  parser.add_argument(
+      '--bench_questions_per_context',
+      type=int,
+      default=4,
+      help='Average number of synthetic questions per paragraph.')
+
   args = parser.parse_args()
 
   if args.metric_name == 'NLL':
@@ -233,6 +335,24 @@ def get_test_args():
       type=str,
       default='submission.csv',
       help='Name for submission file.')
+  parser.add_argument(
+      '--resume_dir',
+      type=str,
+      default=None,
+      help='Directory of an interrupted test run to resume. Predictions are \
+                              appended to its files.')
+  parser.add_argument(
+      '--num_shards',
+      type=int,
+      default=1,
+      help='Number of CPU processes to split the examples across. The model \
+                              weights are shared between processes.')
+  parser.add_argument(
+      '--threads_per_shard',
+      type=int,
+      default=0,
+      help='Intra-op threads per shard. 0 divides the CPUs evenly between \
+                              shards.')
 
   # Require load_path for test.py
   args = parser.parse_args()
@@ -242,6 +362,198 @@ def get_test_args():
   return args
 
 
+def get_server_args():
+  """Get arguments needed in server.py."""
+  parser = argparse.ArgumentParser('Serve a trained model over HTTP')
+
+  add_common_args(parser)
+  add_train_test_args(parser)
+  add_common_setup_args(parser)
+
+  parser.add_argument(
+      '--word2idx_file', type=str, default='./data/word2idx.json')
+  parser.add_argument(
+      '--char2idx_file', type=str, default='./data/char2idx.json')
+  parser.add_argument(
+      '--host', type=str, default='127.0.0.1', help='Host to listen on.')
+  parser.add_argument(
+      '--port', type=int, default=8000, help='Port to listen on.')
+  parser.add_argument(
+      '--max_wait_ms',
+      type=float,
+      default=10.,
+      help='Longest time a request waits for its batch to fill up.')
+  parser.add_argument(
+      '--max_queue_size',
+      type=int,
+      default=1024,
+      help='Max number of requests waiting to be batched. Further requests \
+                              wait until there is room.')
+  parser.add_argument(
+      '--bucket_width',
+      type=int,
+      default=64,
+      help='Width in tokens of the context length buckets used for batching.')
+  parser.add_argument(
+      '--cache_mb',
+      type=int,
+      default=256,
+      help='Size of the cache of context encodings in MB.')
+  parser.add_argument(
+      '--load_test_file',
+      type=str,
+      default=None,
+      help='SQuAD JSON file to draw questions from. If set, starts the server \
+                              and sends it requests from a load generator.')
+  parser.add_argument(
+      '--load_test_requests',
+      type=int,
+      default=1000,
+      help='Number of requests the load generator sends.')
+  parser.add_argument(
+      '--load_test_concurrency',
+      type=int,
+      default=32,
+      help='Number of concurrent clients in the load generator.')
+
+  # Require load_path for server.py
+  args = parser.parse_args()
+  if not args.load_path:
+    parser.error('Missing required argument --load_path')
+
+  return args
+
+
+def get_bench_setup_args():
+  """Get arguments needed in bench_setup.py."""
+  parser = argparse.ArgumentParser(
+      'Benchmark pre-processing on synthetic SQuAD and GloVe files')
+
+  add_common_args(parser)
+  add_common_setup_args(parser)
+  add_setup_args(parser)
+  add_bert_feature_args(parser)
+
+  parser.add_argument(
+      '--work_dir',
+      type=str,
+      default='./save/bench_setup',
+      help='Directory for the synthetic inputs and pre-processed outputs.')
+  parser.add_argument(
+      '--num_articles',
+      type=int,
+      default=20,
+      help='Number of articles in each synthetic split.')
+  parser.add_argument(
+      '--paragraphs_per_article',
+      type=int,
+      default=5,
+      help='Number of paragraphs per synthetic article.')
+  parser.add_argument(
+      '--questions_per_paragraph',
+      type=int,
+      default=5,
+      help='Number of questions per synthetic paragraph.')
+  parser.add_argument(
+      '--words_per_paragraph',
+      type=int,
+      default=120,
+      help='Average number of words in a synthetic paragraph.')
+  parser.add_argument(
+      '--vocab_size',
+      type=int,
+      default=5000,
+      help='Number of distinct words in the synthetic data.')
+  parser.add_argument(
+      '--glove_coverage',
+      type=float,
+      default=0.9,
+      help='Fraction of the synthetic vocabulary with a GloVe vector.')
+  parser.add_argument(
+      '--unanswerable_frac',
+      type=float,
+      default=0.3,
+      help='Fraction of synthetic questions without an answer.')
+  parser.add_argument(
+      '--bench_bert',
+      type=lambda s: s.lower().startswith('t'),
+      default=True,
+      help='Also benchmark setup_bert.py, if pytorch_pretrained_bert is \
+                              installed.')
+  parser.add_argument(
+      '--seed', type=int, default=224, help='Random seed for reproducibility.')
+
+  args = parser.parse_args()
+
+  return args
+
+
+def get_bench_layers_args():
+  """Get arguments needed in bench_layers.py."""
+  parser = argparse.ArgumentParser(
+      'Benchmark BiDAF layers and util functions on synthetic inputs')
+
+  def int_list(s):
+    return [int(x) for x in s.split(',')]
+
+  parser.add_argument(
+      '--batch_sizes',
+      type=int_list,
+      default=[16, 64],
+      help='Comma-separated batch sizes to benchmark.')
+  parser.add_argument(
+      '--c_lens',
+      type=int_list,
+      default=[150, 400],
+      help='Comma-separated context lengths to benchmark.')
+  parser.add_argument(
+      '--q_lens',
+      type=int_list,
+      default=[20],
+      help='Comma-separated question lengths to benchmark.')
+  parser.add_argument(
+      '--hidden_sizes',
+      type=int_list,
+      default=[100],
+      help='Comma-separated hidden sizes to benchmark.')
+  parser.add_argument(
+      '--num_iters',
+      type=int,
+      default=10,
+      help='Number of timed iterations per benchmark.')
+  parser.add_argument(
+      '--num_warmup',
+      type=int,
+      default=2,
+      help='Number of untimed iterations before timing.')
+  parser.add_argument(
+      '--device',
+      type=str,
+      default='cpu',
+      help='Device to run the benchmarks on.')
+  parser.add_argument(
+      '--output_file',
+      type=str,
+      default='./save/bench_layers.json',
+      help='File to write benchmark results to.')
+  parser.add_argument(
+      '--baseline_file',
+      type=str,
+      default=None,
+      help='Results of an earlier run to compare against.')
+  parser.add_argument(
+      '--tolerance',
+      type=float,
+      default=0.1,
+      help='Relative slowdown over the baseline reported as a regression.')
+  parser.add_argument(
+      '--seed', type=int, default=224, help='Random seed for reproducibility.')
+
+  args = parser.parse_args()
+
+  return args
+
+
 def add_common_args(parser):
   """Add arguments common to all 3 scripts: setup.py, train.py, test.py"""
   parser.add_argument(
@@ -259,6 +571,12 @@ def add_common_args(parser):
       '--dev_eval_file', type=str, default='./data/dev_eval.json')
   parser.add_argument(
       '--test_eval_file', type=str, default='./data/test_eval.json')
+  parser.add_argument(
+      '--train_eval_store', type=str, default='./data/train_eval.npz')
+  parser.add_argument(
+      '--dev_eval_store', type=str, default='./data/dev_eval.npz')
+  parser.add_argument(
+      '--test_eval_store', type=str, default='./data/test_eval.npz')
 
 
 def add_train_test_args(parser):
@@ -295,6 +613,24 @@ def add_train_test_args(parser):
       type=lambda s: s.lower().startswith('t'),
       default=True,
       help='Whether to use SQuAD 2.0 (unanswerable) questions.')
+  parser.add_argument(
+      '--group_contexts',
+      type=lambda s: s.lower().startswith('t'),
+      default=True,
+      help='Encode each paragraph once per batch. Disabled automatically \
+                              when training on multiple GPUs.')
+  parser.add_argument(
+      '--profile_start',
+      type=int,
+      default=10,
+      help='Index of the first step to profile, counted from 0.')
+  parser.add_argument(
+      '--profile_steps',
+      type=int,
+      default=0,
+      help='Number of steps to run the PyTorch profiler for. Writes a Chrome \
+                              trace and a summary table to save_dir. \
+                              0 disables profiling.')
   parser.add_argument(
       '--hidden_size',
       type=int,
@@ -0,0 +1,270 @@
+"""Benchmark BiDAF layers and util hot paths on synthetic inputs.
+
+Each benchmark is run over a grid of batch sizes, context and question
+lengths, and hidden sizes. Forward and backward times and peak memory are
+written to a JSON file, which can be passed back as `--baseline_file` to
+flag regressions in a later run. No dataset is needed.
+
+Usage:
+    python bench_layers.py --baseline_file save/bench_layers.json
+"""
+
+import itertools
+import os
+import sys
+import time
+import torch
+import torch.nn.functional as F
+import ujson as json
+
+import layers
+import util
+
+from args import get_bench_layers_args
+from collections import OrderedDict
+
+# Size of the synthetic vocabulary and word vectors, matching GloVe 300d
+VOCAB_SIZE = 2000
+WORD_EMB_SIZE = 300
+CHAR_LIMIT = 16
+
+
+def make_mask(batch_size, seq_len, device):
+  """Make a (batch_size, seq_len) mask with random lengths in
+    [seq_len // 2, seq_len], one of which is `seq_len`.
+    """
+  lengths = torch.randint(seq_len // 2, seq_len + 1, (batch_size,))
+  lengths[0] = seq_len
+  mask = torch.arange(seq_len).unsqueeze(0) < lengths.unsqueeze(1)
+
+  return mask.to(device)
+
+
+def make_examples(batch_size, c_len, q_len, questions_per_context=4):
+  """Make a list of examples in the format returned by `SQuAD.__getitem__`."""
+  examples = []
+  for i in range(batch_size):
+    ctx_idx = i // questions_per_context
+    generator = torch.Generator().manual_seed(ctx_idx)
+    cw_idxs = torch.randint(1, VOCAB_SIZE, (c_len,), generator=generator)
+    cc_idxs = torch.randint(1, 100, (c_len, CHAR_LIMIT), generator=generator)
+    qw_idxs = torch.randint(1, VOCAB_SIZE, (q_len,))
+    qc_idxs = torch.randint(1, 100, (q_len, CHAR_LIMIT))
+    examples.append((cw_idxs, cc_idxs, qw_idxs, qc_idxs,
+                     torch.tensor(0), torch.tensor(1), torch.tensor(i),
+                     torch.tensor(ctx_idx)))
+
+  return examples
+
+
+def get_benchmarks(batch_size, c_len, q_len, hidden_size, device):
+  """Get benchmarks for one point of the grid.
+
+    Returns:
+        benchmarks (list): List of (name, run_fn, backward) tuples, where
+            `run_fn()` runs a forward pass and returns the output tensors.
+    """
+  b, c, q, h = batch_size, c_len, q_len, hidden_size
+  c_mask = make_mask(b, c, device)
+  q_mask = make_mask(b, q, device)
+
+  def leaf(*size):
+    return torch.randn(*size, device=device, requires_grad=True)
+
+  word_vectors = torch.randn(VOCAB_SIZE, WORD_EMB_SIZE)
+  emb = layers.Embedding(word_vectors, h, drop_prob=0.).to(device)
+  cw_idxs = torch.randint(1, VOCAB_SIZE, (b, c), device=device)
+
+  hwy = layers.HighwayEncoder(2, h).to(device)
+  hwy_in = leaf(b, c, h)
+
+  rnn = layers.RNNEncoder(h, h, num_layers=1).to(device)
+  rnn_in = leaf(b, c, h)
+  c_lens = c_mask.sum(-1)
+
+  att = layers.BiDAFAttention(2 * h, drop_prob=0.).to(device)
+  att_c, att_q = leaf(b, c, 2 * h), leaf(b, q, 2 * h)
+
+  out = layers.BiDAFOutput(h, drop_prob=0.).to(device)
+  out_att, out_mod = leaf(b, c, 8 * h), leaf(b, c, 2 * h)
+
+  logits = leaf(b, c, q)
+  softmax_mask = q_mask.view(b, 1, q)
+
+  p_start = F.softmax(torch.randn(b, c, device=device), -1)
+  p_end = F.softmax(torch.randn(b, c, device=device), -1)
+
+  examples = make_examples(b, c, q)
+
+  return [
+      ('Embedding', lambda: emb(cw_idxs), True),
+      ('HighwayEncoder', lambda: hwy(hwy_in), True),
+      ('RNNEncoder', lambda: rnn(rnn_in, c_lens), True),
+      ('BiDAFAttention', lambda: att(att_c, att_q, c_mask, q_mask), True),
+      ('BiDAFOutput', lambda: out(out_att, out_mod, c_mask), True),
+      ('masked_softmax', lambda: util.masked_softmax(logits, softmax_mask, 2),
+       True),
+      ('discretize', lambda: util.discretize(p_start, p_end, 15, True), False),
+      ('collate_fn', lambda: util.collate_fn(examples, group_contexts=True),
+       False),
+  ]
+
+
+def synchronize(device):
+  if device.type == 'cuda':
+    torch.cuda.synchronize(device)
+
+
+def time_benchmark(run_fn, backward, num_iters, num_warmup, device):
+  """Time forward and backward passes of `run_fn`.
+
+    Returns:
+        forward_ms (float): Mean time of a forward pass in milliseconds.
+        backward_ms (float): Mean time of a backward pass in milliseconds,
+            or None if `backward` is False.
+    """
+  forward_time = backward_time = 0.
+  for i in range(num_warmup + num_iters):
+    synchronize(device)
+    tic = time.perf_counter()
+    outputs = run_fn()
+    synchronize(device)
+    toc = time.perf_counter()
+    if i >= num_warmup:
+      forward_time += toc - tic
+
+    if backward:
+      if torch.is_tensor(outputs):
+        outputs = (outputs,)
+      loss = sum(output.sum() for output in outputs)
+      tic = time.perf_counter()
+      loss.backward()
+      synchronize(device)
+      toc = time.perf_counter()
+      if i >= num_warmup:
+        backward_time += toc - tic
+
+  forward_ms = 1000. * forward_time / num_iters
+  backward_ms = 1000. * backward_time / num_iters if backward else None
+
+  return forward_ms, backward_ms
+
+
+def measure_peak_memory(run_fn, backward, device):
+  """Measure peak memory of one forward and backward pass in MB.
+
+    On CUDA this is the peak allocated by the caching allocator. On CPU it is
+    estimated from the allocations and frees recorded by the profiler at the
+    granularity of top-level operators, or None if the profiler cannot
+    record memory.
+    """
+
+  def run():
+    outputs = run_fn()
+    if backward:
+      if torch.is_tensor(outputs):
+        outputs = (outputs,)
+      sum(output.sum() for output in outputs).backward()
+
+  if device.type == 'cuda':
+    synchronize(device)
+    torch.cuda.reset_peak_memory_stats(device)
+    baseline = torch.cuda.memory_allocated(device)
+    run()
+    synchronize(device)
+    return (torch.cuda.max_memory_allocated(device) - baseline) / 2**20
+
+  try:
+    with torch.autograd.profiler.profile(profile_memory=True) as prof:
+      run()
+    events = sorted((event for event in prof.function_events
+                     if event.cpu_parent is None),
+                    key=lambda event: event.time_range.start)
+  except (AttributeError, TypeError):
+    return None
+  in_use = peak = 0
+  for event in events:
+    in_use += event.cpu_memory_usage
+    peak = max(peak, in_use)
+
+  return peak / 2**20
+
+
+def compare(results, baseline, tolerance):
+  """Find benchmarks that got slower than `baseline` by more than `tolerance`.
+
+    Returns:
+        regressions (list): List of (key, metric, baseline, current) tuples.
+    """
+  regressions = []
+  for key, result in results.items():
+    if key not in baseline:
+      continue
+    for metric in ('forward_ms', 'backward_ms'):
+      old, new = baseline[key].get(metric), result.get(metric)
+      if old is not None and new is not None and new > old * (1 + tolerance):
+        regressions.append((key, metric, old, new))
+
+  return regressions
+
+
+def main(args):
+  baseline = None
+  if args.baseline_file:
+    # Load before the results are written, which may be to the same file
+    with open(args.baseline_file, 'r') as fh:
+      baseline = json.load(fh)['results']
+
+  torch.manual_seed(args.seed)
+  torch.set_grad_enabled(True)
+  device = torch.device(args.device)
+
+  # Benchmarks that do not depend on the hidden size run once per grid point
+  hidden_free = ('masked_softmax', 'discretize', 'collate_fn')
+  results = OrderedDict()
+  grid = itertools.product(args.batch_sizes, args.c_lens, args.q_lens,
+                           args.hidden_sizes)
+  print('{:<60} {:>10} {:>10} {:>10}'.format('benchmark', 'fwd (ms)',
+                                             'bwd (ms)', 'mem (MB)'))
+  for batch_size, c_len, q_len, hidden_size in grid:
+    benchmarks = get_benchmarks(batch_size, c_len, q_len, hidden_size, device)
+    for name, run_fn, backward in benchmarks:
+      if name in hidden_free and hidden_size != args.hidden_sizes[0]:
+        continue
+      key = '{} batch_size={} c_len={} q_len={}'.format(
+          name, batch_size, c_len, q_len)
+      if name not in hidden_free:
+        key += ' hidden_size={}'.format(hidden_size)
+      forward_ms, backward_ms = time_benchmark(run_fn, backward,
+                                               args.num_iters,
+                                               args.num_warmup, device)
+      peak_mem_mb = measure_peak_memory(run_fn, backward, device)
+      results[key] = {
+          'forward_ms': forward_ms,
+          'backward_ms': backward_ms,
+          'peak_mem_mb': peak_mem_mb
+      }
+      print('{:<60} {:>10.3f} {:>10} {:>10}'.format(
+          key, forward_ms,
+          '-' if backward_ms is None else '{:.3f}'.format(backward_ms),
+          '-' if peak_mem_mb is None else '{:.1f}'.format(peak_mem_mb)))
+
+  os.makedirs(os.path.dirname(os.path.abspath(args.output_file)),
+              exist_ok=True)
+  with open(args.output_file, 'w') as fh:
+    json.dump({'device': str(device), 'results': results}, fh, indent=2)
+  print('Saved results to {}'.format(args.output_file))
+
+  if baseline is not None:
+    regressions = compare(results, baseline, args.tolerance)
+    for key, metric, old, new in regressions:
+      print('Regression in {} {}: {:.3f} -> {:.3f} ({:+.0%})'.format(
+          key, metric, old, new, new / old - 1))
+    if regressions:
+      sys.exit(1)
+    print('No regressions over {:.0%} against {}'.format(
+        args.tolerance, args.baseline_file))
+
+
+if __name__ == '__main__':
+  main(get_bench_layers_args())
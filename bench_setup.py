@@ -0,0 +1,291 @@
+"""Benchmark pre-processing in setup.py and setup_bert.py on synthetic data.
+
+Generates SQuAD-format JSON files and a small GloVe-format file, then runs
+`setup.pre_process` and the setup_bert.py pipeline over them, timing each
+stage. Everything runs offline: spaCy uses a blank English pipeline and
+the BERT tokenizer uses a vocabulary built from the synthetic words.
+
+Usage:
+    python bench_setup.py --num_articles 100
+"""
+
+import os
+import random
+import resource
+import string
+import sys
+import time
+import ujson as json
+
+import setup
+
+from args import get_bench_setup_args
+from collections import OrderedDict
+
+
+def make_vocab(vocab_size, rng):
+  """Make a list of `vocab_size` distinct lowercase words."""
+  vocab = set()
+  while len(vocab) < vocab_size:
+    length = rng.randint(2, 10)
+    vocab.add(''.join(rng.choice(string.ascii_lowercase)
+                      for _ in range(length)))
+
+  return sorted(vocab)
+
+
+def make_paragraph(vocab, num_words, rng):
+  """Make a paragraph of sentences of words from `vocab`.
+
+    Returns:
+        context (str): Text of the paragraph.
+        sentences (list): List of sentences, each a list of
+            (word, char_offset) pairs.
+    """
+  sentences = []
+  pieces = []
+  offset = 0
+  while num_words > 0:
+    sentence_len = min(rng.randint(5, 20), num_words)
+    num_words -= sentence_len
+    sentence = []
+    for i in range(sentence_len):
+      word = rng.choice(vocab)
+      if i == 0:
+        word = word.capitalize()
+      sentence.append((word, offset))
+      pieces.append(word)
+      offset += len(word) + 1
+    pieces[-1] += '.'
+    offset += 1
+    sentences.append(sentence)
+
+  return ' '.join(pieces), sentences
+
+
+def make_answer(sentences, rng):
+  """Pick a span of 1 to 4 words from one sentence as an answer."""
+  sentence = rng.choice(sentences)
+  length = rng.randint(1, min(4, len(sentence)))
+  start = rng.randint(0, len(sentence) - length)
+  words = sentence[start:start + length]
+  text = ' '.join(word for word, _ in words)
+
+  return {'text': text, 'answer_start': words[0][1]}
+
+
+def make_squad(args, vocab, split, rng):
+  """Make a synthetic SQuAD 2.0 split in the format of the official files."""
+  articles = []
+  num_answers = 1 if split == 'train' else 3
+  for i in range(args.num_articles):
+    paragraphs = []
+    for j in range(args.paragraphs_per_article):
+      num_words = rng.randint(args.words_per_paragraph // 2,
+                              args.words_per_paragraph * 3 // 2)
+      context, sentences = make_paragraph(vocab, num_words, rng)
+      qas = []
+      for k in range(args.questions_per_paragraph):
+        question = ' '.join(
+            rng.choice(vocab) for _ in range(rng.randint(5, 15))) + '?'
+        is_impossible = rng.random() < args.unanswerable_frac
+        answers = [] if is_impossible else [
+            make_answer(sentences, rng) for _ in range(num_answers)
+        ]
+        qas.append({
+            'id': '{}_{}_{}_{}'.format(split, i, j, k),
+            'question': question.capitalize(),
+            'answers': answers[:1] if split == 'train' else answers,
+            'is_impossible': is_impossible
+        })
+      paragraphs.append({'context': context, 'qas': qas})
+    articles.append({'title': '{}_{}'.format(split, i),
+                     'paragraphs': paragraphs})
+
+  return {'version': 'v2.0', 'data': articles}
+
+
+def make_glove(path, vocab, dim, coverage, rng):
+  """Write a GloVe-format file with vectors for a fraction of `vocab`.
+
+    Returns:
+        num_vectors (int): Number of vectors written.
+    """
+  words = [word for word in vocab if rng.random() < coverage]
+  words += [word.capitalize() for word in words[:len(words) // 10]]
+  words += ['.', '?']
+  with open(path, 'w') as fh:
+    for word in words:
+      vector = ' '.join('{:.5f}'.format(rng.gauss(0, 0.1))
+                        for _ in range(dim))
+      fh.write('{} {}\n'.format(word, vector))
+
+  return len(words)
+
+
+def peak_rss_mb():
+  """Get the peak resident set size of this process in MB."""
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    return peak / 2**20  # Bytes on macOS
+  return peak / 2**10  # Kilobytes on Linux
+
+
+class StageTimer:
+  """Time every call to selected module-level functions.
+
+    Functions are looked up through their module when called, so replacing
+    the module attribute with a timed wrapper also times calls made from
+    inside the module, e.g. from `setup.pre_process`.
+    """
+
+  def __init__(self):
+    self.stages = OrderedDict()
+    self.originals = []
+
+  def wrap(self, module, name, count_fn=None):
+    """Time calls to `module.name`.
+
+        Args:
+            module (module): Module that defines the function.
+            name (str): Name of the function.
+            count_fn (function): Called with the arguments and the result of
+                each call to get the number of items processed.
+        """
+    fn = getattr(module, name)
+    stage = self.stages.setdefault(
+        '{}.{}'.format(module.__name__, name), {
+            'calls': 0,
+            'seconds': 0.,
+            'items': 0,
+            'peak_rss_mb': 0.
+        })
+
+    def wrapper(*args, **kwargs):
+      tic = time.perf_counter()
+      result = fn(*args, **kwargs)
+      stage['seconds'] += time.perf_counter() - tic
+      stage['calls'] += 1
+      if count_fn is not None:
+        stage['items'] += count_fn(args, kwargs, result)
+      stage['peak_rss_mb'] = peak_rss_mb()
+      return result
+
+    self.originals.append((module, name, fn))
+    setattr(module, name, wrapper)
+
+  def restore(self):
+    """Remove all wrappers."""
+    for module, name, fn in reversed(self.originals):
+      setattr(module, name, fn)
+    self.originals = []
+
+  def report(self):
+    print('{:<50} {:>6} {:>10} {:>10} {:>12} {:>12}'.format(
+        'stage', 'calls', 'seconds', 'items', 'items/sec', 'peak RSS MB'))
+    for name, stage in self.stages.items():
+      items_per_sec = stage['items'] / stage['seconds'] \
+          if stage['items'] and stage['seconds'] else 0.
+      stage['items_per_sec'] = items_per_sec
+      print('{:<50} {:>6} {:>10.3f} {:>10} {:>12.1f} {:>12.1f}'.format(
+          name, stage['calls'], stage['seconds'], stage['items'],
+          items_per_sec, stage['peak_rss_mb']))
+
+
+def bench_setup(args, timer):
+  """Run `setup.pre_process` with each stage timed."""
+  import spacy
+  setup.nlp = spacy.blank('en')
+
+  timer.wrap(setup, 'process_file', lambda a, kw, result: len(result[0]))
+  timer.wrap(setup, 'get_embedding', lambda a, kw, result: len(a[0]))
+  timer.wrap(setup, 'build_features', lambda a, kw, result: len(a[1]))
+  timer.wrap(setup, 'save')
+  timer.wrap(setup, 'save_eval_store', lambda a, kw, result: len(a[1]))
+  try:
+    tic = time.perf_counter()
+    setup.pre_process(args)
+    print('setup.pre_process took {:.3f}s'.format(time.perf_counter() - tic))
+  finally:
+    timer.restore()
+
+
+def bench_setup_bert(args, vocab, timer):
+  """Run the setup_bert.py pipeline with each stage timed."""
+  try:
+    import setup_bert
+    from pytorch_pretrained_bert.tokenization import BertTokenizer
+  except ImportError:
+    print('Skipping setup_bert.py: pytorch_pretrained_bert is not installed')
+    return
+
+  # Word-level vocabulary so no download is needed
+  vocab_file = os.path.join(args.work_dir, 'bert_vocab.txt')
+  with open(vocab_file, 'w') as fh:
+    for token in ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', '.', '?']:
+      fh.write(token + '\n')
+    for word in vocab:
+      fh.write(word + '\n')
+  tokenizer = BertTokenizer(vocab_file, do_lower_case=args.do_lower_case)
+
+  timer.wrap(setup_bert, 'read_squad_examples',
+             lambda a, kw, result: len(result))
+  timer.wrap(setup_bert, 'convert_examples_to_features',
+             lambda a, kw, result: len(kw['examples']))
+  timer.wrap(setup_bert, 'process_set',
+             lambda a, kw, result: len(kw['examples']))
+  try:
+    splits = [('train', args.train_file, True), ('dev', args.dev_file, False)]
+    if args.include_test_examples:
+      splits.append(('test', args.test_file, False))
+    for name, input_file, is_training in splits:
+      examples = setup_bert.read_squad_examples(
+          input_file=input_file, is_training=is_training)
+      setup_bert.process_set(
+          args,
+          name='{} set'.format(name),
+          examples=examples,
+          tokenizer=tokenizer,
+          is_training=is_training,
+          out_file=os.path.join(args.work_dir, '{}_bert.npz'.format(name)))
+  finally:
+    timer.restore()
+
+
+def main(args):
+  rng = random.Random(args.seed)
+  os.makedirs(args.work_dir, exist_ok=True)
+
+  # Keep all inputs and outputs inside the work directory
+  for key, value in vars(args).items():
+    if isinstance(value, str) and value.startswith('./data/'):
+      setattr(args, key, os.path.join(args.work_dir, os.path.basename(value)))
+
+  # Generate synthetic inputs
+  print('Generating synthetic data in {}...'.format(args.work_dir))
+  vocab = make_vocab(args.vocab_size, rng)
+  splits = ['train', 'dev'] + (['test'] if args.include_test_examples else [])
+  for split in splits:
+    path = os.path.join(args.work_dir, '{}-v2.0.json'.format(split))
+    with open(path, 'w') as fh:
+      json.dump(make_squad(args, vocab, split, rng), fh)
+    setattr(args, '{}_file'.format(split), path)
+  args.glove_file = os.path.join(args.work_dir, 'glove.txt')
+  args.glove_num_vecs = make_glove(args.glove_file, vocab, args.glove_dim,
+                                   args.glove_coverage, rng)
+
+  timer = StageTimer()
+  bench_setup(args, timer)
+  if args.bench_bert:
+    bench_setup_bert(args, vocab, timer)
+
+  print()
+  timer.report()
+  results_file = os.path.join(args.work_dir, 'bench_setup.json')
+  with open(results_file, 'w') as fh:
+    json.dump(timer.stages, fh, indent=2)
+  print('Saved results to {}'.format(results_file))
+
+
+if __name__ == '__main__':
+  main(get_bench_setup_args())
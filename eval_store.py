@@ -0,0 +1,66 @@
+"""Write eval info for a split to a compact binary store.
+
+Kept free of PyTorch so that setup.py can write stores without it. The
+stores are read by `util.EvalStore`.
+"""
+
+import numpy as np
+
+
+def _pack_strings(strings):
+  """Pack strings into one UTF-8 byte array and their character offsets."""
+  offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+  offsets[1:] = np.cumsum([len(string) for string in strings])
+  packed = np.frombuffer(''.join(strings).encode('utf-8'), dtype=np.uint8)
+
+  return packed, offsets
+
+
+def save_eval_store(path, eval_dict):
+  """Write the eval info of a split to a compact binary store.
+
+    Contexts are stored once per paragraph. All strings are packed into flat
+    UTF-8 arrays with offsets, and token character spans are stored in one
+    (num_tokens, 2) array. See `EvalStore` for reading the store.
+
+    Args:
+        path (str): Path of the .npz file to write.
+        eval_dict (dict): Eval info mapping example IDs to dicts with keys
+            'context', 'question', 'spans', 'answers' and 'uuid'.
+    """
+  ids = sorted(int(key) for key in eval_dict)
+  context_rows = {}
+  contexts, spans, span_counts, ctx_idxs = [], [], [], []
+  questions, uuids, answers, answer_counts = [], [], [], []
+  for id_ in ids:
+    example = eval_dict[str(id_)]
+    if example['context'] not in context_rows:
+      context_rows[example['context']] = len(contexts)
+      contexts.append(example['context'])
+      spans.extend(example['spans'])
+      span_counts.append(len(example['spans']))
+    ctx_idxs.append(context_rows[example['context']])
+    questions.append(example['question'])
+    uuids.append(example['uuid'])
+    answers.extend(example['answers'])
+    answer_counts.append(len(example['answers']))
+
+  context_text, context_offsets = _pack_strings(contexts)
+  question_text, question_offsets = _pack_strings(questions)
+  uuid_text, uuid_offsets = _pack_strings(uuids)
+  answer_text, answer_offsets = _pack_strings(answers)
+  np.savez(
+      path,
+      ids=np.array(ids, dtype=np.int64),
+      ctx_idxs=np.array(ctx_idxs, dtype=np.int64),
+      spans=np.array(spans, dtype=np.int64).reshape(-1, 2),
+      span_offsets=np.cumsum([0] + span_counts),
+      context_text=context_text,
+      context_offsets=context_offsets,
+      question_text=question_text,
+      question_offsets=question_offsets,
+      uuid_text=uuid_text,
+      uuid_offsets=uuid_offsets,
+      answer_text=answer_text,
+      answer_offsets=answer_offsets,
+      answer_groups=np.cumsum([0] + answer_counts))
@@ -11,6 +11,14 @@ import torch.nn.functional as F
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from util import masked_softmax
 
+try:
+    # Tensor weights for lerp need a newer PyTorch
+    torch.lerp(torch.zeros(1), torch.ones(1), torch.ones(1))
+    _lerp = torch.lerp
+except (RuntimeError, TypeError):
+    def _lerp(start, end, weight):
+        return start + weight * (end - start)
+
 
 class Embedding(nn.Module):
     """Embedding layer used by BiDAF, without the character-level component.
@@ -53,20 +61,38 @@ class HighwayEncoder(nn.Module):
     """
     def __init__(self, num_layers, hidden_size):
         super(HighwayEncoder, self).__init__()
-        self.transforms = nn.ModuleList([nn.Linear(hidden_size, hidden_size)
-                                         for _ in range(num_layers)])
-        self.gates = nn.ModuleList([nn.Linear(hidden_size, hidden_size)
-                                    for _ in range(num_layers)])
+        self.hidden_size = hidden_size
+        # Each layer computes the gate and transform with one matmul
+        self.layers = nn.ModuleList([nn.Linear(hidden_size, 2 * hidden_size)
+                                     for _ in range(num_layers)])
+        self._register_load_state_dict_pre_hook(self._load_unfused)
 
     def forward(self, x):
-        for gate, transform in zip(self.gates, self.transforms):
+        for layer in self.layers:
+            gt = layer(x)  # (batch_size, seq_len, 2 * hidden_size)
+
             # Shapes of g, t, and x are all (batch_size, seq_len, hidden_size)
-            g = torch.sigmoid(gate(x))
-            t = F.relu(transform(x))
-            x = g * t + (1 - g) * x
+            # Views of gt share its version counter, so only one half can be
+            # modified in place without invalidating the other's saved output
+            g = torch.sigmoid(gt[..., :self.hidden_size])
+            t = gt[..., self.hidden_size:].relu_()
+            x = _lerp(x, t, g)  # g * t + (1 - g) * x
 
         return x
 
+    def _load_unfused(self, state_dict, prefix, *args):
+        """Map separate `gates.i` and `transforms.i` weights of older
+        checkpoints onto the fused layers.
+        """
+        for i in range(len(self.layers)):
+            for name in ('weight', 'bias'):
+                gate_key = '{}gates.{}.{}'.format(prefix, i, name)
+                transform_key = '{}transforms.{}.{}'.format(prefix, i, name)
+                if gate_key in state_dict and transform_key in state_dict:
+                    state_dict['{}layers.{}.{}'.format(prefix, i, name)] = \
+                        torch.cat([state_dict.pop(gate_key),
+                                   state_dict.pop(transform_key)])
+
 
 class RNNEncoder(nn.Module):
     """General-purpose layer for encoding a sequence using a bidirectional RNN.
@@ -198,7 +224,8 @@ class BiDAFOutput(nn.Module):
     """
     def __init__(self, hidden_size, drop_prob):
         super(BiDAFOutput, self).__init__()
-        self.att_linear_1 = nn.Linear(8 * hidden_size, 1)
+        # Projects att to the start and end logits in one pass
+        self.att_linear = nn.Linear(8 * hidden_size, 2)
         self.mod_linear_1 = nn.Linear(2 * hidden_size, 1)
 
         self.rnn = RNNEncoder(input_size=2 * hidden_size,
@@ -206,17 +233,30 @@ class BiDAFOutput(nn.Module):
                               num_layers=1,
                               drop_prob=drop_prob)
 
-        self.att_linear_2 = nn.Linear(8 * hidden_size, 1)
         self.mod_linear_2 = nn.Linear(2 * hidden_size, 1)
+        self._register_load_state_dict_pre_hook(self._load_unfused)
 
     def forward(self, att, mod, mask):
+        att_logits = self.att_linear(att)  # (batch_size, seq_len, 2)
+
         # Shapes: (batch_size, seq_len, 1)
-        logits_1 = self.att_linear_1(att) + self.mod_linear_1(mod)
+        logits_1 = att_logits.narrow(-1, 0, 1) + self.mod_linear_1(mod)
         mod_2 = self.rnn(mod, mask.sum(-1))
-        logits_2 = self.att_linear_2(att) + self.mod_linear_2(mod_2)
+        logits_2 = att_logits.narrow(-1, 1, 1) + self.mod_linear_2(mod_2)
 
         # Shapes: (batch_size, seq_len)
-        log_p1 = masked_softmax(logits_1.squeeze(), mask, log_softmax=True)
-        log_p2 = masked_softmax(logits_2.squeeze(), mask, log_softmax=True)
+        log_p1 = masked_softmax(logits_1.squeeze(-1), mask, log_softmax=True)
+        log_p2 = masked_softmax(logits_2.squeeze(-1), mask, log_softmax=True)
 
         return log_p1, log_p2
+
+    def _load_unfused(self, state_dict, prefix, *args):
+        """Map separate `att_linear_1` and `att_linear_2` weights of older
+        checkpoints onto `att_linear`.
+        """
+        for name in ('weight', 'bias'):
+            keys = ['{}att_linear_{}.{}'.format(prefix, i, name)
+                    for i in (1, 2)]
+            if all(key in state_dict for key in keys):
+                state_dict['{}att_linear.{}'.format(prefix, name)] = \
+                    torch.cat([state_dict.pop(key) for key in keys])
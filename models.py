@@ -4,9 +4,15 @@ Author:
     Chris Chute (chute@stanford.edu)
 """
 
+import hashlib
 import layers
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import util
+
+from collections import OrderedDict
+from torch.nn.utils.rnn import pad_sequence
 
 
 class BiDAFBERTEmbeddings(nn.Module):
@@ -50,6 +56,10 @@ class BiDAF(nn.Module):
         word_vectors (torch.Tensor): Pre-trained word vectors.
         hidden_size (int): Number of features in the hidden state at each layer.
         drop_prob (float): Dropout probability.
+
+    The forward pass accepts an optional `c_map` of shape (batch_size,) that
+    maps each question to a row of `cw_idxs`. Questions about the same
+    paragraph then share a single context embedding and encoding.
     """
 
   def __init__(self, word_vectors, hidden_size, drop_prob=0.):
@@ -76,17 +86,72 @@ class BiDAF(nn.Module):
 
     self.out = layers.BiDAFOutput(hidden_size=hidden_size, drop_prob=drop_prob)
 
-  def forward(self, cw_idxs, qw_idxs):
+  def forward(self, cw_idxs, qw_idxs, c_map=None):
+    c_enc, c_mask, q_enc, q_mask = self.encode(cw_idxs, qw_idxs)
+
+    out = self.decode(c_enc, c_mask, q_enc, q_mask, c_map)
+
+    return out
+
+  def encode(self, cw_idxs, qw_idxs):
+    """Embed and encode contexts and questions together.
+
+        Same as `encode_context` and `encode_question`, but with one call to
+        the embedding and one to the encoder. The embedding runs on all word
+        indices flattened into a single sequence. The encoder runs on the
+        contexts and questions stacked along the batch dimension, padded to
+        the longer of the two lengths.
+        """
     c_mask = torch.zeros_like(cw_idxs) != cw_idxs
     q_mask = torch.zeros_like(qw_idxs) != qw_idxs
-    c_len, q_len = c_mask.sum(-1), q_mask.sum(-1)
+    (num_contexts, c_len), (batch_size, q_len) = cw_idxs.size(), qw_idxs.size()
+    max_len = max(c_len, q_len)
+
+    # (1, num_contexts * c_len + batch_size * q_len, hidden_size)
+    emb = self.emb(torch.cat([cw_idxs.view(1, -1), qw_idxs.view(1, -1)], 1))
+    c_emb, q_emb = emb.squeeze(0).split(
+        [num_contexts * c_len, batch_size * q_len])
+    c_emb = c_emb.view(num_contexts, c_len, -1)
+    q_emb = q_emb.view(batch_size, q_len, -1)
+
+    # (num_contexts + batch_size, max_len, hidden_size)
+    x = torch.cat([F.pad(c_emb, (0, 0, 0, max_len - c_len)),
+                   F.pad(q_emb, (0, 0, 0, max_len - q_len))])
+    lengths = torch.cat([c_mask.sum(-1), q_mask.sum(-1)])
+    enc = self.enc(x, lengths)  # (..., max_len, 2 * hidden_size)
+    c_enc = enc[:num_contexts, :c_len]  # (num_contexts, c_len, 2 * hidden_size)
+    q_enc = enc[num_contexts:, :q_len]  # (batch_size, q_len, 2 * hidden_size)
+
+    return c_enc, c_mask, q_enc, q_mask
+
+  def encode_context(self, cw_idxs):
+    """Embed and encode contexts. Does not depend on the questions."""
+    c_mask = torch.zeros_like(cw_idxs) != cw_idxs
+    c_len = c_mask.sum(-1)
 
-    c_emb = self.emb(cw_idxs)  # (batch_size, c_len, hidden_size)
-    q_emb = self.emb(qw_idxs)  # (batch_size, q_len, hidden_size)
+    c_emb = self.emb(cw_idxs)  # (num_contexts, c_len, hidden_size)
+    c_enc = self.enc(c_emb, c_len)  # (num_contexts, c_len, 2 * hidden_size)
+
+    return c_enc, c_mask
 
-    c_enc = self.enc(c_emb, c_len)  # (batch_size, c_len, 2 * hidden_size)
+  def encode_question(self, qw_idxs):
+    """Embed and encode questions."""
+    q_mask = torch.zeros_like(qw_idxs) != qw_idxs
+    q_len = q_mask.sum(-1)
+
+    q_emb = self.emb(qw_idxs)  # (batch_size, q_len, hidden_size)
     q_enc = self.enc(q_emb, q_len)  # (batch_size, q_len, 2 * hidden_size)
 
+    return q_enc, q_mask
+
+  def decode(self, c_enc, c_mask, q_enc, q_mask, c_map=None):
+    """Run attention, modeling and output layers on encoded inputs."""
+    if c_map is not None:
+      # Broadcast each encoded context to the questions asked about it
+      c_enc = c_enc[c_map]  # (batch_size, c_len, 2 * hidden_size)
+      c_mask = c_mask[c_map]
+    c_len = c_mask.sum(-1)
+
     att = self.att(c_enc, q_enc, c_mask,
                    q_mask)  # (batch_size, c_len, 8 * hidden_size)
 
@@ -95,3 +160,76 @@ class BiDAF(nn.Module):
     out = self.out(att, mod, c_mask)  # 2 tensors, each (batch_size, c_len)
 
     return out
+
+
+class CachedBiDAF:
+  """Inference wrapper around `BiDAF` that caches context encodings.
+
+    Embedding and encoding a context does not depend on the question, so
+    the encoding of each paragraph is cached under a hash of its word indices.
+    Questions about a cached paragraph only pay for the question encoder,
+    attention, modeling and output layers.
+
+    Args:
+        model (BiDAF): Trained model. May be wrapped in `nn.DataParallel`.
+        max_bytes (int): Maximum total size of cached context encodings.
+    """
+
+  def __init__(self, model, max_bytes=256 * 1024**2):
+    self.model = getattr(model, 'module', model)
+    self.cache = util.TensorLRUCache(max_bytes)
+
+  def __call__(self, cw_idxs, qw_idxs):
+    """Get start and end log-probabilities for a batch of questions.
+
+        Args:
+            cw_idxs (torch.Tensor): Context word indices of each question.
+                Shape (batch_size, c_len).
+            qw_idxs (torch.Tensor): Question word indices.
+                Shape (batch_size, q_len).
+
+        Returns:
+            log_p1, log_p2 (torch.Tensor): Same as `BiDAF.forward`.
+        """
+    if self.model.training:
+      raise RuntimeError('CachedBiDAF requires the model in eval mode')
+
+    with torch.no_grad():
+      # Group questions by paragraph
+      lengths = (cw_idxs != 0).sum(-1).tolist()
+      rows = cw_idxs.cpu().numpy()
+      keys = [
+          hashlib.sha1(rows[i, :length].tobytes()).hexdigest()
+          for i, length in enumerate(lengths)
+      ]
+      firsts = OrderedDict()  # Paragraph key -> first question about it
+      for i, key in enumerate(keys):
+        firsts.setdefault(key, i)
+      positions = {key: pos for pos, key in enumerate(firsts)}
+      c_map = torch.tensor([positions[key] for key in keys],
+                           device=qw_idxs.device)
+
+      # Encode paragraphs missing from the cache
+      encodings = {key: self.cache.get(key) for key in firsts}
+      missing = [i for key, i in firsts.items() if encodings[key] is None]
+      if missing:
+        c_enc, _ = self.model.encode_context(cw_idxs[missing])
+        for row, i in enumerate(missing):
+          encodings[keys[i]] = c_enc[row, :lengths[i]].clone()
+          self.cache.put(keys[i], encodings[keys[i]])
+
+      # Pad encodings back into a batch
+      c_idxs = cw_idxs[list(firsts.values())]
+      c_mask = torch.zeros_like(c_idxs) != c_idxs
+      c_enc = pad_sequence([encodings[key] for key in firsts],
+                           batch_first=True)
+      c_enc = F.pad(c_enc, (0, 0, 0, c_mask.size(1) - c_enc.size(1)))
+
+      q_enc, q_mask = self.model.encode_question(qw_idxs)
+      out = self.model.decode(c_enc, c_mask, q_enc, q_mask, c_map)
+
+    return out
+
+  def stats(self):
+    """Get cache statistics (hits, misses, evictions, entries, bytes)."""
+    return self.cache.stats()
@@ -0,0 +1,403 @@
+"""Serve a trained model over HTTP with dynamic batching.
+
+Requests are tokenized with the same pipeline as `setup.convert_to_features`.
+Concurrent requests are grouped into batches of questions whose contexts
+have similar lengths. A batch runs as soon as it is full or its oldest
+request has waited `--max_wait_ms`.
+
+Endpoints:
+    POST /predict   Body {"context": ..., "question": ...}. Returns the
+                    predicted answer and its character offsets in the context.
+    GET /metrics    Latency percentiles, batch sizes and queue depth.
+
+Usage:
+    > python server.py --load_path PATH --name NAME
+    Or, to send the server requests from a local load generator:
+    > python server.py --load_path PATH --name NAME \
+          --load_test_file data/dev-v2.0.json
+"""
+
+import asyncio
+import numpy as np
+import spacy
+import time
+import torch
+import torch.nn as nn
+import ujson as json
+import util
+
+import setup
+
+from args import get_server_args
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from json import dumps
+from models import BiDAF, CachedBiDAF
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                500: 'Internal Server Error'}
+
+
+def percentiles(values, qs=(50, 90, 99)):
+  """Get percentiles of `values` as a dict, e.g. {'p50': ...}."""
+  if not values:
+    return {'p{}'.format(q): None for q in qs}
+  return {
+      'p{}'.format(q): float(p)
+      for q, p in zip(qs, np.percentile(list(values), qs))
+  }
+
+
+class ServerMetrics:
+  """Keep latencies and batch sizes of recent requests.
+
+    Args:
+        window (int): Number of recent requests and batches to keep.
+    """
+
+  def __init__(self, window=10000):
+    self.latencies = deque(maxlen=window)
+    self.batch_sizes = deque(maxlen=window)
+    self.num_requests = 0
+    self.num_errors = 0
+    self.start = time.perf_counter()
+
+  def summary(self, queue_size):
+    elapsed = time.perf_counter() - self.start
+    latency_ms = percentiles([1000. * t for t in self.latencies])
+    batch_size = percentiles(self.batch_sizes)
+    batch_size['mean'] = float(np.mean(self.batch_sizes)) \
+        if self.batch_sizes else None
+
+    return {
+        'requests': self.num_requests,
+        'errors': self.num_errors,
+        'requests_per_sec': self.num_requests / elapsed,
+        'latency_ms': latency_ms,
+        'batch_size': batch_size,
+        'queue_size': queue_size
+    }
+
+
+class DynamicBatcher:
+  """Group concurrent requests into batches with similar context lengths.
+
+    Requests are put on a bounded queue, so when the model falls behind,
+    callers of `submit` wait for room instead of piling up work. Requests
+    are sorted into buckets by context length. A bucket is run as a batch
+    once it holds `max_batch_size` requests or its oldest request has waited
+    `max_wait` seconds. Batches run one at a time in a worker thread, so the
+    event loop keeps accepting requests meanwhile.
+
+    Args:
+        run_batch (function): Maps a list of requests to a list of results.
+        max_batch_size (int): Maximum number of requests per batch.
+        max_wait (float): Longest time in seconds a request waits for its
+            batch to fill up.
+        max_queue_size (int): Maximum number of queued requests.
+        bucket_width (int): Width in tokens of the context length buckets.
+    """
+
+  def __init__(self, run_batch, max_batch_size, max_wait, max_queue_size,
+               bucket_width):
+    self.run_batch = run_batch
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait
+    self.bucket_width = bucket_width
+    self.queue = asyncio.Queue(maxsize=max_queue_size)
+    self.pending = {}  # Bucket -> list of (request, future, arrival time)
+    self.executor = ThreadPoolExecutor(max_workers=1)
+    self.metrics = ServerMetrics()
+
+  async def submit(self, request, length):
+    """Queue a request and wait for its result.
+
+        Args:
+            request (object): Request to pass to `run_batch`.
+            length (int): Length of the request's context in tokens.
+        """
+    future = asyncio.get_event_loop().create_future()
+    arrival = time.perf_counter()
+    await self.queue.put((length // self.bucket_width, request, future,
+                          arrival))
+    result = await future
+    self.metrics.latencies.append(time.perf_counter() - arrival)
+
+    return result
+
+  async def run(self):
+    """Batch and run queued requests forever."""
+    while True:
+      timeout = None
+      if self.pending:
+        oldest = min(requests[0][2] for requests in self.pending.values())
+        timeout = max(0., oldest + self.max_wait - time.perf_counter())
+
+      # Wait for a request, then take everything else already queued
+      batches = []
+      try:
+        self._add(await asyncio.wait_for(self.queue.get(), timeout), batches)
+        while not self.queue.empty():
+          self._add(self.queue.get_nowait(), batches)
+      except asyncio.TimeoutError:
+        pass
+
+      now = time.perf_counter()
+      expired = [
+          bucket for bucket, requests in self.pending.items()
+          if now - requests[0][2] >= self.max_wait
+      ]
+      batches += [self.pending.pop(bucket) for bucket in expired]
+      for requests in batches:
+        await self._flush(requests)
+
+  def _add(self, item, batches):
+    bucket, request, future, arrival = item
+    requests = self.pending.setdefault(bucket, [])
+    requests.append((request, future, arrival))
+    if len(requests) == self.max_batch_size:
+      batches.append(self.pending.pop(bucket))
+
+  async def _flush(self, requests):
+    self.metrics.batch_sizes.append(len(requests))
+    loop = asyncio.get_event_loop()
+    try:
+      results = await loop.run_in_executor(
+          self.executor, self.run_batch,
+          [request for request, _, _ in requests])
+    except Exception as e:
+      for _, future, _ in requests:
+        if not future.done():
+          future.set_exception(e)
+      return
+
+    for (_, future, _), result in zip(requests, results):
+      if not future.done():
+        future.set_result(result)
+
+
+class QAServer:
+  """Answer questions about contexts over HTTP using a trained BiDAF.
+
+    Args:
+        args (argparse.Namespace): Arguments from `get_server_args`.
+        model (BiDAF): Trained model in eval mode.
+        device (torch.device): Device the model runs on.
+        word2idx_dict (dict): Word to index in the embedding matrix.
+        char2idx_dict (dict): Character to index in the embedding matrix.
+    """
+
+  def __init__(self, args, model, device, word2idx_dict, char2idx_dict):
+    self.args = args
+    self.model = CachedBiDAF(model, max_bytes=args.cache_mb * 2**20)
+    self.device = device
+    self.word2idx_dict = word2idx_dict
+    self.char2idx_dict = char2idx_dict
+    self.batcher = DynamicBatcher(
+        self.predict,
+        max_batch_size=args.batch_size,
+        max_wait=args.max_wait_ms / 1000.,
+        max_queue_size=args.max_queue_size,
+        bucket_width=args.bucket_width)
+
+  def featurize(self, context, question):
+    """Tokenize and index a (context, question) pair like setup.py does."""
+    context_idxs, _, ques_idxs, _, context_tokens, ques_tokens = \
+        setup.convert_to_features(self.args, (context, question),
+                                  self.word2idx_dict, self.char2idx_dict,
+                                  is_test=True, return_tokens=True)
+    context_idxs = context_idxs[:len(context_tokens)].astype(np.int64)
+    ques_idxs = ques_idxs[:len(ques_tokens)].astype(np.int64)
+    if self.args.use_squad_v2:
+      # SQuAD 2.0: Use index 0 for no-answer token (token 1 = OOV)
+      context_idxs = np.concatenate(([1], context_idxs))
+      ques_idxs = np.concatenate(([1], ques_idxs))
+    # Replacing quotes keeps lengths, so spans index the original context
+    spans = setup.convert_idx(
+        context.replace("''", '" ').replace("``", '" '), context_tokens)
+
+    return {
+        'context': context,
+        'context_idxs': context_idxs,
+        'ques_idxs': ques_idxs,
+        'spans': spans
+    }
+
+  def predict(self, requests):
+    """Predict answers for a batch of featurized requests."""
+
+    def merge(arrays):
+      padded = torch.zeros(len(arrays), max(len(a) for a in arrays),
+                           dtype=torch.int64)
+      for i, array in enumerate(arrays):
+        padded[i, :len(array)] = torch.from_numpy(array)
+      return padded.to(self.device)
+
+    cw_idxs = merge([request['context_idxs'] for request in requests])
+    qw_idxs = merge([request['ques_idxs'] for request in requests])
+    log_p1, log_p2 = self.model(cw_idxs, qw_idxs)
+    starts, ends = util.discretize(log_p1.exp(), log_p2.exp(),
+                                   self.args.max_ans_len,
+                                   self.args.use_squad_v2)
+
+    results = []
+    offset = int(self.args.use_squad_v2)
+    for request, start, end in zip(requests, starts.tolist(), ends.tolist()):
+      if self.args.use_squad_v2 and start == 0:
+        results.append({'answer': '', 'start': None, 'end': None})
+        continue
+      start_char = request['spans'][start - offset][0]
+      end_char = request['spans'][end - offset][1]
+      results.append({
+          'answer': request['context'][start_char:end_char],
+          'start': start_char,
+          'end': end_char
+      })
+
+    return results
+
+  async def answer(self, body):
+    data = json.loads(body)
+    loop = asyncio.get_event_loop()
+    request = await loop.run_in_executor(None, self.featurize,
+                                         data['context'], data['question'])
+    return await self.batcher.submit(request, len(request['context_idxs']))
+
+  async def handle(self, reader, writer):
+    """Handle one HTTP request per connection."""
+    try:
+      method, path, _ = (await reader.readline()).decode().split(' ', 2)
+      headers = {}
+      while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+          break
+        key, value = line.decode().split(':', 1)
+        headers[key.strip().lower()] = value.strip()
+      body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+      if method == 'POST' and path == '/predict':
+        self.batcher.metrics.num_requests += 1
+        status, response = 200, await self.answer(body)
+      elif method == 'GET' and path == '/metrics':
+        response = self.batcher.metrics.summary(self.batcher.queue.qsize())
+        response['cache'] = self.model.stats()
+        status = 200
+      else:
+        status, response = 404, {'error': 'Unknown endpoint'}
+    except (ValueError, KeyError) as e:
+      self.batcher.metrics.num_errors += 1
+      status, response = 400, {'error': str(e)}
+    except Exception as e:
+      self.batcher.metrics.num_errors += 1
+      status, response = 500, {'error': str(e)}
+
+    payload = json.dumps(response).encode('utf-8')
+    writer.write('HTTP/1.1 {} {}\r\n'
+                 'Content-Type: application/json\r\n'
+                 'Content-Length: {}\r\n'
+                 'Connection: close\r\n\r\n'.format(
+                     status, HTTP_REASONS[status], len(payload)).encode())
+    writer.write(payload)
+    await writer.drain()
+    writer.close()
+
+
+async def send_request(host, port, method, path, data=None):
+  """Send an HTTP request and get the status and decoded JSON response."""
+  reader, writer = await asyncio.open_connection(host, port)
+  body = json.dumps(data).encode('utf-8') if data is not None else b''
+  writer.write('{} {} HTTP/1.1\r\n'
+               'Host: {}\r\n'
+               'Content-Type: application/json\r\n'
+               'Content-Length: {}\r\n\r\n'.format(method, path, host,
+                                                  len(body)).encode())
+  writer.write(body)
+  await writer.drain()
+  response = await reader.read()
+  writer.close()
+  head, _, payload = response.partition(b'\r\n\r\n')
+  status = int(head.split(b' ', 2)[1])
+
+  return status, json.loads(payload)
+
+
+async def load_test(args, log):
+  """Send questions from `args.load_test_file` from concurrent clients."""
+  with open(args.load_test_file, 'r') as fh:
+    source = json.load(fh)
+  pairs = [(para['context'], qa['question'])
+           for article in source['data']
+           for para in article['paragraphs']
+           for qa in para['qas']]
+  num_requests = args.load_test_requests
+  log.info('Sending {} requests from {} clients...'.format(
+      num_requests, args.load_test_concurrency))
+
+  latencies = []
+  statuses = []
+  next_request = iter(range(num_requests))
+
+  async def client():
+    for i in next_request:
+      context, question = pairs[i % len(pairs)]
+      tic = time.perf_counter()
+      status, _ = await send_request(args.host, args.port, 'POST',
+                                     '/predict', {'context': context,
+                                                  'question': question})
+      latencies.append(time.perf_counter() - tic)
+      statuses.append(status)
+
+  tic = time.perf_counter()
+  await asyncio.gather(
+      *[client() for _ in range(args.load_test_concurrency)])
+  elapsed = time.perf_counter() - tic
+
+  latency_ms = percentiles([1000. * t for t in latencies])
+  log.info('Client: {:.1f} requests/sec, {} errors, latency (ms) {}'.format(
+      num_requests / elapsed, sum(status != 200 for status in statuses),
+      ', '.join('{} {:.1f}'.format(k, v) for k, v in latency_ms.items())))
+  _, metrics = await send_request(args.host, args.port, 'GET', '/metrics')
+  log.info('Server: {}'.format(dumps(metrics, indent=4, sort_keys=True)))
+
+
+def main(args):
+  # Set up logging
+  args.save_dir = util.get_save_dir(args.save_dir, args.name, training=False)
+  log = util.get_logger(args.save_dir, args.name)
+  log.info('Args: {}'.format(dumps(vars(args), indent=4, sort_keys=True)))
+  device, gpu_ids = util.get_available_devices()
+
+  # Get embeddings and vocabularies
+  log.info('Loading embeddings...')
+  word_vectors = util.torch_from_json(args.word_emb_file)
+  with open(args.word2idx_file, 'r') as fh:
+    word2idx_dict = json.load(fh)
+  with open(args.char2idx_file, 'r') as fh:
+    char2idx_dict = json.load(fh)
+  setup.nlp = spacy.blank('en')
+
+  # Get model
+  log.info('Building model...')
+  model = BiDAF(word_vectors=word_vectors, hidden_size=args.hidden_size)
+  model = nn.DataParallel(model, gpu_ids)
+  log.info('Loading checkpoint from {}...'.format(args.load_path))
+  model = util.load_model(model, args.load_path, gpu_ids, return_step=False)
+  model = model.to(device)
+  model.eval()
+
+  # Start serving
+  server = QAServer(args, model, device, word2idx_dict, char2idx_dict)
+  loop = asyncio.get_event_loop()
+  loop.run_until_complete(
+      asyncio.start_server(server.handle, args.host, args.port))
+  asyncio.ensure_future(server.batcher.run())
+  log.info('Serving on http://{}:{}...'.format(args.host, args.port))
+  if args.load_test_file:
+    loop.run_until_complete(load_test(args, log))
+  else:
+    loop.run_forever()
+
+
+if __name__ == '__main__':
+  main(get_server_args())
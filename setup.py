@@ -20,6 +20,7 @@ import urllib.request
 from args import get_setup_args
 from codecs import open
 from collections import Counter
+from eval_store import save_eval_store
 from subprocess import run
 from tqdm import tqdm
 from zipfile import ZipFile
@@ -93,10 +94,12 @@ def process_file(filename, data_type, word_counter, char_counter):
   examples = []
   eval_examples = {}
   total = 0
+  num_contexts = 0
   with open(filename, "r") as fh:
     source = json.load(fh)
     for article in tqdm(source["data"]):
       for para in article["paragraphs"]:
+        num_contexts += 1
         context = para["context"].replace("''", '" ').replace("``", '" ')
         context_tokens = word_tokenize(context)
         context_chars = [list(token) for token in context_tokens]
@@ -135,7 +138,8 @@ def process_file(filename, data_type, word_counter, char_counter):
               "ques_chars": ques_chars,
               "y1s": y1s,
               "y2s": y2s,
-              "id": total
+              "id": total,
+              "context_id": num_contexts
           }
           examples.append(example)
           eval_examples[str(total)] = {
@@ -197,7 +201,12 @@ def get_embedding(counter,
   return emb_mat, token2idx_dict
 
 
-def convert_to_features(args, data, word2idx_dict, char2idx_dict, is_test):
+def convert_to_features(args,
+                        data,
+                        word2idx_dict,
+                        char2idx_dict,
+                        is_test,
+                        return_tokens=False):
   example = {}
   context, question = data
   context = context.replace("''", '" ').replace("``", '" ')
@@ -254,6 +263,9 @@ def convert_to_features(args, data, word2idx_dict, char2idx_dict, is_test):
         break
       ques_char_idxs[i, j] = _get_char(char)
 
+  if return_tokens:
+    return context_idxs, context_char_idxs, ques_idxs, ques_char_idxs, \
+        example['context_tokens'], example['ques_tokens']
   return context_idxs, context_char_idxs, ques_idxs, ques_char_idxs
 
 
@@ -295,6 +307,8 @@ def build_features(args,
   y1s = []
   y2s = []
   ids = []
+  ctx_idxs = []
+  context_rows = {}  # Context ID -> row in the context arrays
   for n, example in tqdm(enumerate(examples)):
     total_ += 1
 
@@ -314,26 +328,32 @@ def build_features(args,
         return char2idx_dict[char]
       return 1
 
-    context_idx = np.zeros([para_limit], dtype=np.int32)
-    context_char_idx = np.zeros([para_limit, char_limit], dtype=np.int32)
+    # Store each context once, shared by all of its questions
+    if example["context_id"] not in context_rows:
+      context_rows[example["context_id"]] = len(context_idxs)
+
+      context_idx = np.zeros([para_limit], dtype=np.int32)
+      context_char_idx = np.zeros([para_limit, char_limit], dtype=np.int32)
+
+      for i, token in enumerate(example["context_tokens"]):
+        context_idx[i] = _get_word(token)
+      context_idxs.append(context_idx)
+
+      for i, token in enumerate(example["context_chars"]):
+        for j, char in enumerate(token):
+          if j == char_limit:
+            break
+          context_char_idx[i, j] = _get_char(char)
+      context_char_idxs.append(context_char_idx)
+    ctx_idxs.append(context_rows[example["context_id"]])
+
     ques_idx = np.zeros([ques_limit], dtype=np.int32)
     ques_char_idx = np.zeros([ques_limit, char_limit], dtype=np.int32)
 
-    for i, token in enumerate(example["context_tokens"]):
-      context_idx[i] = _get_word(token)
-    context_idxs.append(context_idx)
-
     for i, token in enumerate(example["ques_tokens"]):
       ques_idx[i] = _get_word(token)
     ques_idxs.append(ques_idx)
 
-    for i, token in enumerate(example["context_chars"]):
-      for j, char in enumerate(token):
-        if j == char_limit:
-          break
-        context_char_idx[i, j] = _get_char(char)
-    context_char_idxs.append(context_char_idx)
-
     for i, token in enumerate(example["ques_chars"]):
       for j, char in enumerate(token):
         if j == char_limit:
@@ -358,8 +378,10 @@ def build_features(args,
       ques_char_idxs=np.array(ques_char_idxs),
       y1s=np.array(y1s),
       y2s=np.array(y2s),
-      ids=np.array(ids))
+      ids=np.array(ids),
+      ctx_idxs=np.array(ctx_idxs))
   print("Built {} / {} instances of features in total".format(total, total_))
+  print("{} unique contexts in total".format(len(context_idxs)))
   meta["total"] = total
   return meta
 
@@ -396,6 +418,7 @@ def pre_process(args):
     test_examples, test_eval = process_file(args.test_file, "test",
                                             word_counter, char_counter)
     save(args.test_eval_file, test_eval, message="test eval")
+    save_eval_store(args.test_eval_store, test_eval)
     test_meta = build_features(
         args,
         test_examples,
@@ -410,6 +433,8 @@ def pre_process(args):
   save(args.char_emb_file, char_emb_mat, message="char embedding")
   save(args.train_eval_file, train_eval, message="train eval")
   save(args.dev_eval_file, dev_eval, message="dev eval")
+  save_eval_store(args.train_eval_store, train_eval)
+  save_eval_store(args.dev_eval_store, dev_eval)
   save(args.word2idx_file, word2idx_dict, message="word dictionary")
   save(args.char2idx_file, char2idx_dict, message="char dictionary")
   save(args.dev_meta_file, dev_meta, message="dev meta")
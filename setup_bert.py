@@ -410,17 +410,24 @@ def process_set(args, name: str, examples, tokenizer, is_training: bool,
   CONTEXT_SEGMENT = 1
 
   context_idxs = []
+  context_char_idxs = []
   ques_idxs = []
+  ques_char_idxs = []
   y1s = []
   y2s = []
   ids = []
-  for feature in train_features:
+  for feature in features:
     # This is the index which begins the "context" (points to the token)
     # after [SEP].
     context_offset = feature.segment_ids.index(CONTEXT_SEGMENT)
     ids.append(feature.unique_id)
-    y1s.append(feature.start_position - context_offset)
-    y2s.append(feature.end_position - context_offset)
+    if feature.start_position is None:
+      # No answer positions outside of training
+      y1s.append(-1)
+      y2s.append(-1)
+    else:
+      y1s.append(feature.start_position - context_offset)
+      y2s.append(feature.end_position - context_offset)
 
     context_idx = np.zeros([para_limit], dtype=np.int32)
     context_char_idx = np.zeros([para_limit, char_limit], dtype=np.int32)
@@ -440,7 +447,7 @@ def process_set(args, name: str, examples, tokenizer, is_training: bool,
     context_idxs.append(context_idx)
     context_char_idxs.append(context_char_idx)
     ques_idxs.append(ques_idx)
-    ques_char_idxs.append(ques_char_idxs)
+    ques_char_idxs.append(ques_char_idx)
 
   np.savez(
       out_file,
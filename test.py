@@ -11,8 +11,10 @@ Author:
     Chris Chute (chute@stanford.edu)
 """
 
-import csv
+import os
+import random
 import torch
+import torch.multiprocessing as mp
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.data as data
@@ -20,22 +22,34 @@ import util
 
 from args import get_test_args
 from collections import OrderedDict
+from functools import partial
 from json import dumps
 from models import BiDAF
 from os.path import join
 from tensorboardX import SummaryWriter
 from tqdm import tqdm
-from ujson import load as json_load
 from util import collate_fn, SQuAD
 
 
 def main(args):
     # Set up logging
-    args.save_dir = util.get_save_dir(args.save_dir, args.name, training=False)
+    if args.resume_dir:
+        # Continue writing predictions of an interrupted run
+        args.save_dir = args.resume_dir
+    else:
+        args.save_dir = util.get_save_dir(args.save_dir, args.name,
+                                          training=False)
     log = util.get_logger(args.save_dir, args.name)
     log.info('Args: {}'.format(dumps(vars(args), indent=4, sort_keys=True)))
     device, gpu_ids = util.get_available_devices()
+    if args.num_shards > 1:
+        # Shards split the work across CPU cores
+        log.info('Running {} shards on CPU...'.format(args.num_shards))
+        device, gpu_ids = torch.device('cpu'), []
     args.batch_size *= max(1, len(gpu_ids))
+    if len(gpu_ids) > 1:
+        # DataParallel scatters contexts and questions independently
+        args.group_contexts = False
 
     # Get embeddings
     log.info('Loading embeddings...')
@@ -45,41 +59,120 @@ def main(args):
     log.info('Building model...')
     model = BiDAF(word_vectors=word_vectors,
                   hidden_size=args.hidden_size)
-    model = nn.DataParallel(model, gpu_ids)
+    if args.num_shards == 1:
+        # DataParallel needs a device when CUDA is available, so shards
+        # use the bare model
+        model = nn.DataParallel(model, gpu_ids)
     log.info('Loading checkpoint from {}...'.format(args.load_path))
     model = util.load_model(model, args.load_path, gpu_ids, return_step=False)
     model = model.to(device)
     model.eval()
 
+    # Get gold answers
+    eval_file = vars(args)['{}_eval_file'.format(args.split)]
+    eval_store = vars(args)['{}_eval_store'.format(args.split)]
+    gold_dict = util.load_eval_store(eval_store, eval_file)
+    record_file = vars(args)['{}_record_file'.format(args.split)]
+    num_examples = len(SQuAD(record_file, args.use_squad_v2))
+
+    # Evaluate
+    log.info('Evaluating on {} split...'.format(args.split))
+    if args.num_shards > 1:
+        nll_meter, eval_meter, samples, preds_paths = run_shards(
+            args, model, num_examples, log)
+    else:
+        profiler = util.ProfilerWindow(args.save_dir,
+                                       args.profile_start,
+                                       args.profile_steps,
+                                       device,
+                                       model=model,
+                                       log=log)
+        nll_meter, eval_meter, writer = predict_range(
+            args, model, device, gold_dict, args.save_dir, 0, num_examples,
+            profiler=profiler, log=log)
+        profiler.close()
+        writer.close()
+        samples = writer.sample_dict()
+        preds_paths = [writer.preds_path]
+
+    # Log results (except for test set, since it does not come with labels)
+    if args.split != 'test':
+        results = eval_meter.results()
+        results_list = [('NLL', nll_meter.avg),
+                        ('F1', results['F1']),
+                        ('EM', results['EM'])]
+        if args.use_squad_v2:
+            results_list.append(('AvNA', results['AvNA']))
+        results = OrderedDict(results_list)
+
+        # Log to console
+        results_str = ', '.join('{}: {:05.2f}'.format(k, v)
+                                for k, v in results.items())
+        log.info('{} {}'.format(args.split.title(), results_str))
+
+        # Log to TensorBoard
+        tbx = SummaryWriter(args.save_dir)
+        util.visualize(tbx,
+                       pred_dict=samples,
+                       eval_dict=gold_dict,
+                       step=0,
+                       split=args.split,
+                       num_visuals=args.num_visuals)
+
+    # Write submission file
+    sub_path = join(args.save_dir, args.split + '_' + args.sub_file)
+    log.info('Writing submission file to {}...'.format(sub_path))
+    util.merge_predictions(preds_paths, sub_path)
+
+
+def predict_range(args, model, device, gold_dict, save_dir, start, end,
+                  profiler=None, log=None, position=0):
+    """Predict examples `start` to `end` of the split, streaming predictions
+    to a `util.PredictionWriter` in `save_dir`.
+
+    Returns:
+        nll_meter (util.AverageMeter): NLL over the examples.
+        eval_meter (util.EvalMeter): EM, F1 and AvNA over the examples.
+        writer (util.PredictionWriter): Writer holding the predictions.
+    """
+    writer = util.PredictionWriter(save_dir,
+                                   resume=bool(args.resume_dir),
+                                   num_samples=args.num_visuals,
+                                   log=log)
+    nll_meter = util.AverageMeter()
+    eval_meter = util.EvalMeter(gold_dict.gold_answers, args.use_squad_v2)
+    if writer.state is not None:
+        if writer.state.get('range', [start, end]) != [start, end]:
+            raise ValueError('Cannot resume predictions for examples {} with '
+                             'examples {}'.format(writer.state['range'],
+                                                  [start, end]))
+        nll_meter.load_state_dict(writer.state['nll'])
+        eval_meter.load_state_dict(writer.state['metrics'])
+
     # Get data loader
-    log.info('Building dataset...')
     record_file = vars(args)['{}_record_file'.format(args.split)]
     dataset = SQuAD(record_file, args.use_squad_v2)
+    batch_sampler = data.BatchSampler(range(start + writer.num_examples, end),
+                                      args.batch_size,
+                                      drop_last=False)
     data_loader = data.DataLoader(dataset,
-                                  batch_size=args.batch_size,
-                                  shuffle=False,
+                                  batch_sampler=batch_sampler,
                                   num_workers=args.num_workers,
-                                  collate_fn=collate_fn)
+                                  collate_fn=partial(collate_fn,
+                                                     group_contexts=args.group_contexts),
+                                  pin_memory=device.type == 'cuda')
 
-    # Evaluate
-    log.info('Evaluating on {} split...'.format(args.split))
-    nll_meter = util.AverageMeter()
-    pred_dict = {}  # Predictions for TensorBoard
-    sub_dict = {}   # Predictions for submission
-    eval_file = vars(args)['{}_eval_file'.format(args.split)]
-    with open(eval_file, 'r') as fh:
-        gold_dict = json_load(fh)
     with torch.no_grad(), \
-            tqdm(total=len(dataset)) as progress_bar:
-        for cw_idxs, cc_idxs, qw_idxs, qc_idxs, y1, y2, ids in data_loader:
+            tqdm(total=end - start, initial=writer.num_examples,
+                 position=position) as progress_bar:
+        batches = util.DevicePrefetcher(data_loader, device,
+                                        util.BATCH_DEVICE_FIELDS)
+        for cw_idxs, cc_idxs, qw_idxs, qc_idxs, y1, y2, ids, c_map in batches:
             # Setup for forward
-            cw_idxs = cw_idxs.to(device)
-            qw_idxs = qw_idxs.to(device)
-            batch_size = cw_idxs.size(0)
+            batch_size = qw_idxs.size(0)
 
             # Forward
-            log_p1, log_p2 = model(cw_idxs, qw_idxs)
-            y1, y2 = y1.to(device), y2.to(device)
+            log_p1, log_p2 = model(cw_idxs, qw_idxs, c_map)
             loss = F.nll_loss(log_p1, y1) + F.nll_loss(log_p2, y2)
             nll_meter.update(loss.item(), batch_size)
 
@@ -98,41 +191,98 @@ def main(args):
                                                       starts.tolist(),
                                                       ends.tolist(),
                                                       args.use_squad_v2)
-            pred_dict.update(idx2pred)
-            sub_dict.update(uuid2pred)
+            if args.split != 'test':
+                eval_meter.update(idx2pred)
+            writer.write(idx2pred, uuid2pred,
+                         state={'range': [start, end],
+                                'nll': nll_meter.state_dict(),
+                                'metrics': eval_meter.state_dict()})
+            if profiler is not None:
+                profiler.step()
 
-    # Log results (except for test set, since it does not come with labels)
-    if args.split != 'test':
-        results = util.eval_dicts(gold_dict, pred_dict, args.use_squad_v2)
-        results_list = [('NLL', nll_meter.avg),
-                        ('F1', results['F1']),
-                        ('EM', results['EM'])]
-        if args.use_squad_v2:
-            results_list.append(('AvNA', results['AvNA']))
-        results = OrderedDict(results_list)
+    if log is not None:
+        log.info('Waited {:.2f}s for data'.format(batches.total_wait_time))
 
-        # Log to console
-        results_str = ', '.join('{}: {:05.2f}'.format(k, v)
-                                for k, v in results.items())
-        log.info('{} {}'.format(args.split.title(), results_str))
+    return nll_meter, eval_meter, writer
 
-        # Log to TensorBoard
-        tbx = SummaryWriter(args.save_dir)
-        util.visualize(tbx,
-                       pred_dict=pred_dict,
-                       eval_path=eval_file,
-                       step=0,
-                       split=args.split,
-                       num_visuals=args.num_visuals)
 
-    # Write submission file
-    sub_path = join(args.save_dir, args.split + '_' + args.sub_file)
-    log.info('Writing submission file to {}...'.format(sub_path))
-    with open(sub_path, 'w', newline='', encoding='utf-8') as csv_fh:
-        csv_writer = csv.writer(csv_fh, delimiter=',')
-        csv_writer.writerow(['Id', 'Predicted'])
-        for uuid in sorted(sub_dict):
-            csv_writer.writerow([uuid, sub_dict[uuid]])
+def run_shards(args, model, num_examples, log):
+    """Split the examples into `args.num_shards` contiguous shards and
+    predict each in its own process.
+
+    The model's tensors are moved to shared memory, so the processes share
+    one copy of the weights and the word embeddings.
+
+    Returns:
+        nll_meter (util.AverageMeter): NLL over all examples.
+        eval_meter (util.EvalMeter): EM, F1 and AvNA over all examples.
+        samples (dict): Random sample of predictions for visualization.
+        preds_paths (list): Paths of the per-shard predictions files.
+    """
+    num_threads = args.threads_per_shard \
+        or max(1, (os.cpu_count() or 1) // args.num_shards)
+    log.info('Using {} threads per shard...'.format(num_threads))
+    model.share_memory()
+    bounds = [num_examples * i // args.num_shards
+              for i in range(args.num_shards + 1)]
+
+    context = mp.get_context('spawn')
+    results = context.SimpleQueue()
+    processes = []
+    for shard in range(args.num_shards):
+        shard_dir = join(args.save_dir, 'shard_{:02d}'.format(shard))
+        os.makedirs(shard_dir, exist_ok=True)
+        process = context.Process(target=run_shard,
+                                  args=(args, model, shard, shard_dir,
+                                        bounds[shard], bounds[shard + 1],
+                                        num_threads, results))
+        process.start()
+        processes.append(process)
+    shard_results = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    failed = [result for result in shard_results if 'error' in result]
+    if failed:
+        raise RuntimeError('Shard {} failed: {}'.format(failed[0]['shard'],
+                                                        failed[0]['error']))
+
+    # Merge results in shard order
+    shard_results.sort(key=lambda result: result['shard'])
+    nll_meter = util.AverageMeter()
+    metrics = {'em': 0., 'f1': 0., 'avna': 0., 'total': 0}
+    samples = []
+    for result in shard_results:
+        if result['nll']['count'] > 0:
+            nll_meter.update(result['nll']['avg'], result['nll']['count'])
+        for key in metrics:
+            metrics[key] += result['metrics'][key]
+        samples += result['samples'].items()
+    eval_meter = util.EvalMeter(None, args.use_squad_v2)
+    eval_meter.load_state_dict(metrics)
+    samples = dict(random.sample(samples, min(len(samples), args.num_visuals)))
+    preds_paths = [result['preds_path'] for result in shard_results]
+
+    return nll_meter, eval_meter, samples, preds_paths
+
+
+def run_shard(args, model, shard, save_dir, start, end, num_threads, results):
+    """Predict one shard in a worker process started by `run_shards`."""
+    torch.set_num_threads(num_threads)
+    try:
+        eval_file = vars(args)['{}_eval_file'.format(args.split)]
+        eval_store = vars(args)['{}_eval_store'.format(args.split)]
+        gold_dict = util.load_eval_store(eval_store, eval_file)
+        nll_meter, eval_meter, writer = predict_range(
+            args, model, torch.device('cpu'), gold_dict, save_dir, start, end,
+            position=shard)
+        writer.close()
+        results.put({'shard': shard,
+                     'nll': nll_meter.state_dict(),
+                     'metrics': eval_meter.state_dict(),
+                     'samples': writer.sample_dict(),
+                     'preds_path': writer.preds_path})
+    except Exception as e:
+        results.put({'shard': shard, 'error': repr(e)})
 
 
 if __name__ == '__main__':
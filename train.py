@@ -5,22 +5,27 @@ Author:
 """
 
 import numpy as np
+import queue
 import random
+import resource
+import time
+import traceback
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+import torch.multiprocessing as mp
 import torch.optim.lr_scheduler as sched
 import torch.utils.data as data
 import util
 
 from args import get_train_args
 from collections import OrderedDict
+from functools import partial
 from json import dumps
 from models import BiDAF
 from tensorboardX import SummaryWriter
 from tqdm import tqdm
-from ujson import load as json_load
 from util import collate_fn, SQuAD
 
 
@@ -32,6 +37,11 @@ def main(args):
   device, args.gpu_ids = util.get_available_devices()
   log.info('Args: {}'.format(dumps(vars(args), indent=4, sort_keys=True)))
   args.batch_size *= max(1, len(args.gpu_ids))
+  args.max_tokens *= max(1, len(args.gpu_ids))
+  if len(args.gpu_ids) > 1 and args.group_contexts:
+    # DataParallel scatters contexts and questions independently
+    log.info('Disabling context grouping for multi-GPU training...')
+    args.group_contexts = False
 
   # Set random seed
   log.info('Using random seed {}...'.format(args.seed))
@@ -53,8 +63,10 @@ def main(args):
   model = nn.DataParallel(model, args.gpu_ids)
   if args.load_path:
     log.info('Loading checkpoint from {}...'.format(args.load_path))
-    model, step = util.load_model(model, args.load_path, args.gpu_ids)
+    ckpt_dict = util.load_checkpoint(args.load_path, args.gpu_ids)
+    model, step = util.load_model(model, ckpt_dict, args.gpu_ids)
   else:
+    ckpt_dict = None
     step = 0
   model = model.to(device)
   model.train()
@@ -66,7 +78,8 @@ def main(args):
       max_checkpoints=args.max_checkpoints,
       metric_name=args.metric_name,
       maximize_metric=args.maximize_metric,
-      log=log)
+      log=log,
+      frozen_files={'module.emb.embed.weight': args.word_emb_file})
 
   # Get optimizer and scheduler
   optimizer = optim.Adadelta(
@@ -75,68 +88,139 @@ def main(args):
 
   # Get data loader
   log.info('Building dataset...')
+  batch_collate_fn = partial(collate_fn, group_contexts=args.group_contexts)
   train_dataset = SQuAD(args.train_record_file, args.use_squad_v2)
   if args.num_train_samples:
-    train_sampler = data.SubsetRandomSampler(range(args.num_train_samples))
-    shuffle = False
+    train_indices = range(args.num_train_samples)
   else:
-    train_sampler = None
-    shuffle = True
+    train_indices = None
+  train_sampler = util.ContextGroupedBatchSampler(
+      train_dataset,
+      args.batch_size,
+      shuffle=True,
+      indices=train_indices,
+      max_tokens=args.max_tokens,
+      with_questions=args.max_tokens_with_questions)
   train_loader = data.DataLoader(
       train_dataset,
-      batch_size=args.batch_size,
-      shuffle=shuffle,
+      batch_sampler=train_sampler,
       num_workers=args.num_workers,
-      collate_fn=collate_fn,
-      sampler=train_sampler)
+      collate_fn=batch_collate_fn,
+      pin_memory=device.type == 'cuda')
   dev_dataset = SQuAD(args.dev_record_file, args.use_squad_v2)
   if args.num_dev_samples:
-    dev_sampler = data.SubsetRandomSampler(range(args.num_dev_samples))
+    dev_indices = range(args.num_dev_samples)
   else:
-    dev_sampler = None
-  dev_loader = data.DataLoader(
+    dev_indices = None
+  dev_sampler = util.ContextGroupedBatchSampler(
       dev_dataset,
-      batch_size=args.batch_size,
+      args.batch_size,
       shuffle=False,
+      indices=dev_indices,
+      max_tokens=args.max_tokens,
+      with_questions=args.max_tokens_with_questions)
+  dev_loader = data.DataLoader(
+      dev_dataset,
+      batch_sampler=dev_sampler,
       num_workers=args.num_workers,
-      collate_fn=collate_fn,
-      sampler=dev_sampler)
+      collate_fn=batch_collate_fn,
+      pin_memory=device.type == 'cuda')
+  dev_eval = util.load_eval_store(args.dev_eval_store, args.dev_eval_file)
+  if args.async_eval:
+    log.info('Starting evaluation process on {}...'.format(args.eval_device))
+    evaluator = AsyncEvaluator(args)
+  else:
+    evaluator = None
+
+  def log_dev_results(eval_step, results, pred_dict):
+    # Log to console
+    results_str = ', '.join(
+        '{}: {:05.2f}'.format(k, v) for k, v in results.items())
+    log.info('Dev {} at step {}'.format(results_str, eval_step))
+
+    # Log to TensorBoard
+    log.info('Visualizing in TensorBoard...')
+    for k, v in results.items():
+      tbx.add_scalar('dev/{}'.format(k), v, eval_step)
+    util.visualize(
+        tbx,
+        pred_dict=pred_dict,
+        eval_dict=dev_eval,
+        step=eval_step,
+        split='dev',
+        num_visuals=args.num_visuals)
+
+  def report_async_results(finished):
+    for eval_step, results, pred_dict in finished:
+      saver.report(eval_step, results[args.metric_name])
+      log_dev_results(eval_step, results, pred_dict)
+
+  # Restore training state
+  train_state = ckpt_dict.get('train_state') if ckpt_dict else None
+  if train_state and any('.hwy.gates.' in name or '.att_linear_1.' in name
+                         for name in ckpt_dict['model_state']):
+    # Optimizer and EMA state are laid out by the old, unfused parameters
+    log.warning('Checkpoint predates fused highway and output layers. '
+                'Loaded weights only, not the training state.')
+    train_state = None
+  if train_state:
+    log.info('Resuming training at epoch {}...'.format(train_state['epoch']))
+    optimizer.load_state_dict(train_state['optimizer'])
+    scheduler.load_state_dict(train_state['scheduler'])
+    ema.load_state_dict(train_state['ema'])
+    train_sampler.load_state_dict(train_state['sampler'])
+    steps_till_eval = train_state['steps_till_eval']
+    epoch = train_state['epoch'] - 1
+    rng_state = train_state['rng']
+    num_updates = train_state.get('num_updates', step // args.batch_size)
+  else:
+    steps_till_eval = args.eval_steps
+    num_updates = step // args.batch_size
+    epoch = step // len(train_dataset)
+    rng_state = None
 
   # Train
   log.info('Training...')
-  steps_till_eval = args.eval_steps
-  epoch = step // len(train_dataset)
+  timer = util.PhaseTimer(device, args.perf_window)
+  profiler = util.ProfilerWindow(
+      args.save_dir,
+      args.profile_start,
+      args.profile_steps,
+      device,
+      model=model,
+      log=log)
   while epoch != args.num_epochs:
     epoch += 1
     log.info('Starting epoch {}...'.format(epoch))
+    batches = iter(train_loader)
+    if rng_state is not None:
+      # Creating the iterator draws a seed, so restore RNG state afterwards
+      util.set_rng_state(rng_state)
+      rng_state = None
+    batches = util.DevicePrefetcher(batches, device,
+                                    util.BATCH_DEVICE_FIELDS)
+    num_batches = 0
     with torch.enable_grad(), \
             tqdm(total=len(train_loader.dataset)) as progress_bar:
-      for cw_idxs, cc_idxs, qw_idxs, qc_idxs, y1, y2, ids in train_loader:
-        # Setup for forward
-        cw_idxs = cw_idxs.to(device)
-        qw_idxs = qw_idxs.to(device)
-        batch_size = cw_idxs.size(0)
-        optimizer.zero_grad()
-
-        # Forward
-        log_p1, log_p2 = model(cw_idxs, qw_idxs)
-        y1, y2 = y1.to(device), y2.to(device)
-        loss = F.nll_loss(log_p1, y1) + F.nll_loss(log_p2, y2)
-        loss_val = loss.item()
-
-        # Backward
-        loss.backward()
-        nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
-        optimizer.step()
-        scheduler.step(step // batch_size)
-        ema(model, step // batch_size)
+      for batch in batches:
+        num_batches += 1
+
+        # Forward and backward
+        batch_size = batch[2].size(0)
+        timer.add('data', batches.wait_time)
+        loss_val = train_step(model, optimizer, scheduler, ema, batch,
+                              args.max_grad_norm, num_updates, timer)
 
         # Log info
         step += batch_size
+        num_updates += 1
         progress_bar.update(batch_size)
         progress_bar.set_postfix(epoch=epoch, NLL=loss_val)
-        tbx.add_scalar('train/NLL', loss_val, step)
-        tbx.add_scalar('train/LR', optimizer.param_groups[0]['lr'], step)
+        with timer.phase('tbx'):
+          tbx.add_scalar('train/NLL', loss_val, step)
+          tbx.add_scalar('train/LR', optimizer.param_groups[0]['lr'], step)
+        timer.write(tbx, step)
+        profiler.step()
 
         steps_till_eval -= batch_size
         if steps_till_eval <= 0:
@@ -145,48 +229,236 @@ def main(args):
           # Evaluate and save checkpoint
           log.info('Evaluating at step {}...'.format(step))
           ema.assign(model)
-          results, pred_dict = evaluate(model, dev_loader, device,
-                                        args.dev_eval_file, args.max_ans_len,
-                                        args.use_squad_v2)
-          saver.save(step, model, results[args.metric_name], device)
+          if evaluator is not None:
+            # Wait for a free slot so snapshots do not pile up in memory
+            report_async_results(
+                evaluator.poll(
+                    block=True, max_pending=args.max_pending_evals - 1))
+
+            # Metric is reported to the saver once evaluation finishes
+            evaluator.submit(step, model)
+            results = None
+          else:
+            results, pred_dict = evaluate(model, dev_loader, device,
+                                          dev_eval, args.max_ans_len,
+                                          args.use_squad_v2)
+          train_state = {
+              'epoch': epoch,
+              'steps_till_eval': steps_till_eval,
+              'num_updates': num_updates,
+              'optimizer': optimizer.state_dict(),
+              'scheduler': scheduler.state_dict(),
+              'ema': ema.state_dict(),
+              'sampler': train_sampler.state_dict(num_batches),
+              'rng': util.get_rng_state()
+          }
+          saver.save(
+              step,
+              model,
+              results[args.metric_name] if results else None,
+              train_state=train_state)
           ema.resume(model)
+          timer.reset()  # Keep evaluation out of the throughput stats
+
+          if results is not None:
+            log_dev_results(step, results, pred_dict)
+
+        if evaluator is not None:
+          report_async_results(evaluator.poll())
+
+    log.info('Waited {:.2f}s for data in epoch {}'.format(
+        batches.total_wait_time, epoch))
+
+  profiler.close()
+  if evaluator is not None:
+    log.info('Waiting for evaluation process...')
+    report_async_results(evaluator.poll(block=True))
+    evaluator.close()
+  saver.close()
+
+
+def train_step(model, optimizer, scheduler, ema, batch, max_grad_norm,
+               num_updates, timer):
+  """Take one optimization step on a batch from `collate_fn`.
+
+    Args:
+        model (torch.nn.Module): Model to train.
+        optimizer (torch.optim.Optimizer): Optimizer for the model.
+        scheduler (torch.optim.lr_scheduler.LambdaLR): LR scheduler.
+        ema (util.EMA): Exponential moving average of the parameters.
+        batch (tuple): Batch with its model inputs and labels on the device.
+        max_grad_norm (float): Maximum gradient norm for clipping.
+        num_updates (int): Number of updates taken so far.
+        timer (util.PhaseTimer): Timer for the phases of the step.
+
+    Returns:
+        loss_val (float): Loss on the batch.
+    """
+  cw_idxs, cc_idxs, qw_idxs, qc_idxs, y1, y2, ids, c_map = batch
+  timer.count(cw_idxs, qw_idxs, c_map)
+  optimizer.zero_grad()
+
+  # Forward
+  with timer.phase('forward'):
+    log_p1, log_p2 = model(cw_idxs, qw_idxs, c_map)
+    loss = F.nll_loss(log_p1, y1) + F.nll_loss(log_p2, y2)
+    loss_val = loss.item()
+
+  # Backward
+  with timer.phase('backward'):
+    loss.backward()
+  with timer.phase('clip'):
+    nn.utils.clip_grad_norm_(model.parameters(), max_grad_norm)
+  with timer.phase('optimizer'):
+    optimizer.step()
+    scheduler.step(num_updates)
+  with timer.phase('ema'):
+    ema(model, num_updates)
+
+  return loss_val
+
+
+def make_synthetic_batches(args, num_batches, vocab_size):
+  """Make batches with context and question lengths distributed like SQuAD.
+
+    Paragraph lengths follow a normal distribution fit to SQuAD 2.0 train
+    contexts, capped at `args.bench_para_limit`, and each paragraph is shared
+    by several questions. Batches are collated with `collate_fn`, so padding
+    and context grouping match real training.
+
+    Returns:
+        batches (list): List of batches in the format of `collate_fn`.
+    """
+  rng = np.random.RandomState(args.seed)
+  offset = int(args.use_squad_v2)  # SQuAD 2.0 prepends a no-answer token
+  batches = []
+  ctx_idx = 0
+  for _ in range(num_batches):
+    examples = []
+    while len(examples) < args.batch_size:
+      c_len = int(np.clip(rng.normal(120, 55), 20, args.bench_para_limit))
+      cw_idxs = torch.from_numpy(rng.randint(2, vocab_size, c_len + offset))
+      cw_idxs[:offset] = 1
+      cc_idxs = torch.ones(c_len + offset, 1, dtype=torch.int64)
+      for _ in range(rng.randint(1, 2 * args.bench_questions_per_context)):
+        q_len = int(np.clip(rng.normal(11, 3.5), 3, 40))
+        qw_idxs = torch.from_numpy(rng.randint(2, vocab_size, q_len + offset))
+        qw_idxs[:offset] = 1
+        qc_idxs = torch.ones(q_len + offset, 1, dtype=torch.int64)
+        if args.use_squad_v2 and rng.rand() < 1 / 3:
+          y1 = y2 = 0
+        else:
+          y1 = rng.randint(0, c_len)
+          y2 = min(y1 + rng.randint(0, 4), c_len - 1)
+          y1, y2 = y1 + offset, y2 + offset
+        examples.append(
+            (cw_idxs.long(), cc_idxs, qw_idxs.long(), qc_idxs,
+             torch.tensor(y1), torch.tensor(y2), torch.tensor(len(examples)),
+             torch.tensor(ctx_idx)))
+        if len(examples) == args.batch_size:
+          break
+      ctx_idx += 1
+    batches.append(collate_fn(examples, group_contexts=args.group_contexts))
+
+  return batches
+
+
+def benchmark(args):
+  """Measure training throughput on synthetic data.
+
+    Runs `args.bench_warmup_steps` untimed and `args.bench_steps` timed
+    steps through `train_step`, without reading data from disk, writing to
+    TensorBoard, evaluating or saving checkpoints.
+    """
+  device, args.gpu_ids = util.get_available_devices()
+  args.batch_size *= max(1, len(args.gpu_ids))
+  if len(args.gpu_ids) > 1:
+    args.group_contexts = False
+  random.seed(args.seed)
+  np.random.seed(args.seed)
+  torch.manual_seed(args.seed)
+  torch.cuda.manual_seed_all(args.seed)
+
+  # Synthetic embeddings and batches the size of GloVe 300d on SQuAD
+  word_vectors = 0.1 * torch.randn(args.bench_vocab_size, 300)
+  model = BiDAF(
+      word_vectors=word_vectors,
+      hidden_size=args.hidden_size,
+      drop_prob=args.drop_prob)
+  model = nn.DataParallel(model, args.gpu_ids).to(device)
+  model.train()
+  ema = util.EMA(model, args.ema_decay)
+  optimizer = optim.Adadelta(
+      model.parameters(), args.lr, weight_decay=args.l2_wd)
+  scheduler = sched.LambdaLR(optimizer, lambda s: 1.)
+  batches = make_synthetic_batches(args, args.bench_num_batches,
+                                   args.bench_vocab_size)
+  batch_tokens = []
+  for batch in batches:
+    c_tokens = (batch[0] != 0).sum(-1)
+    if batch[7] is not None:
+      # Count each question's context, even when shared within a batch
+      c_tokens = c_tokens[batch[7]]
+    batch_tokens.append(c_tokens.sum().item() + (batch[2] != 0).sum().item())
+  batches = list(
+      util.DevicePrefetcher(batches, device, util.BATCH_DEVICE_FIELDS))
+
+  timer = util.PhaseTimer(device, window=0)
+  num_steps = args.bench_warmup_steps + args.bench_steps
+  num_examples = num_tokens = 0
+  with torch.enable_grad():
+    for i in range(num_steps):
+      if i == args.bench_warmup_steps:
+        if device.type == 'cuda':
+          torch.cuda.synchronize(device)
+          if hasattr(torch.cuda, 'reset_peak_memory_stats'):
+            torch.cuda.reset_peak_memory_stats(device)
+        tic = time.perf_counter()
+      batch = batches[i % len(batches)]
+      train_step(model, optimizer, scheduler, ema, batch, args.max_grad_norm,
+                 i, timer)
+      if i >= args.bench_warmup_steps:
+        num_examples += batch[2].size(0)
+        num_tokens += batch_tokens[i % len(batches)]
+  if device.type == 'cuda':
+    torch.cuda.synchronize(device)
+  elapsed = time.perf_counter() - tic
+
+  print('Timed {} steps after {} warm-up steps on {}'.format(
+      args.bench_steps, args.bench_warmup_steps, device))
+  print('steps/sec:    {:.2f}'.format(args.bench_steps / elapsed))
+  print('examples/sec: {:.1f}'.format(num_examples / elapsed))
+  print('tokens/sec:   {:.1f}'.format(num_tokens / elapsed))
+  if device.type == 'cuda':
+    peak_mem = torch.cuda.max_memory_allocated(device) / 2**20
+    print('peak memory:  {:.1f} MB (CUDA)'.format(peak_mem))
+  else:
+    peak_mem = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    print('peak memory:  {:.1f} MB (max RSS)'.format(peak_mem))
+
 
-          # Log to console
-          results_str = ', '.join(
-              '{}: {:05.2f}'.format(k, v) for k, v in results.items())
-          log.info('Dev {}'.format(results_str))
-
-          # Log to TensorBoard
-          log.info('Visualizing in TensorBoard...')
-          for k, v in results.items():
-            tbx.add_scalar('dev/{}'.format(k), v, step)
-          util.visualize(
-              tbx,
-              pred_dict=pred_dict,
-              eval_path=args.dev_eval_file,
-              step=step,
-              split='dev',
-              num_visuals=args.num_visuals)
-
-
-def evaluate(model, data_loader, device, eval_file, max_len, use_squad_v2):
+def evaluate(model,
+             data_loader,
+             device,
+             eval_store,
+             max_len,
+             use_squad_v2,
+             show_progress=True):
   nll_meter = util.AverageMeter()
 
   model.eval()
   pred_dict = {}
-  with open(eval_file, 'r') as fh:
-    gold_dict = json_load(fh)
   with torch.no_grad(), \
-          tqdm(total=len(data_loader.dataset)) as progress_bar:
-    for cw_idxs, cc_idxs, qw_idxs, qc_idxs, y1, y2, ids in data_loader:
+          tqdm(total=len(data_loader.dataset),
+               disable=not show_progress) as progress_bar:
+    batches = util.DevicePrefetcher(data_loader, device,
+                                    util.BATCH_DEVICE_FIELDS)
+    for cw_idxs, cc_idxs, qw_idxs, qc_idxs, y1, y2, ids, c_map in batches:
       # Setup for forward
-      cw_idxs = cw_idxs.to(device)
-      qw_idxs = qw_idxs.to(device)
-      batch_size = cw_idxs.size(0)
+      batch_size = qw_idxs.size(0)
 
       # Forward
-      log_p1, log_p2 = model(cw_idxs, qw_idxs)
-      y1, y2 = y1.to(device), y2.to(device)
+      log_p1, log_p2 = model(cw_idxs, qw_idxs, c_map)
       loss = F.nll_loss(log_p1, y1) + F.nll_loss(log_p2, y2)
       nll_meter.update(loss.item(), batch_size)
 
@@ -198,13 +470,15 @@ def evaluate(model, data_loader, device, eval_file, max_len, use_squad_v2):
       progress_bar.update(batch_size)
       progress_bar.set_postfix(NLL=nll_meter.avg)
 
-      preds, _ = util.convert_tokens(gold_dict, ids.tolist(), starts.tolist(),
-                                     ends.tolist(), use_squad_v2)
+      preds, _ = util.convert_tokens(eval_store, ids.tolist(),
+                                     starts.tolist(), ends.tolist(),
+                                     use_squad_v2)
       pred_dict.update(preds)
 
   model.train()
 
-  results = util.eval_dicts(gold_dict, pred_dict, use_squad_v2)
+  results = util.eval_dicts(eval_store, pred_dict, use_squad_v2,
+                            eval_store.gold_answers)
   results_list = [('NLL', nll_meter.avg), ('F1', results['F1']),
                   ('EM', results['EM'])]
   if use_squad_v2:
@@ -214,5 +488,149 @@ def evaluate(model, data_loader, device, eval_file, max_len, use_squad_v2):
   return results, pred_dict
 
 
+class AsyncEvaluator:
+  """Evaluate snapshots of the model on the dev set in a separate process.
+
+    Training continues while the evaluation process scores a snapshot. The
+    process builds its own copy of the model on `args.eval_device`, so only
+    the trainable weights are sent with each request.
+
+    Args:
+        args (argparse.Namespace): Arguments from `get_train_args`.
+        poll_interval (float): Seconds between checks that the evaluation
+            process is still alive while blocking on results.
+    """
+
+  def __init__(self, args, poll_interval=5.):
+    context = mp.get_context('spawn')
+    self.requests = context.Queue()
+    self.results = context.Queue()
+    self.process = context.Process(
+        target=run_eval_worker,
+        args=(args, self.requests, self.results),
+        daemon=True)
+    self.process.start()
+    self.num_pending = 0
+    self.poll_interval = poll_interval
+
+  def submit(self, step, model):
+    """Queue a snapshot of the current weights of `model` for evaluation."""
+    model = getattr(model, 'module', model)
+    frozen = {
+        name for name, param in model.named_parameters()
+        if not param.requires_grad
+    }
+    state = {
+        name: tensor.detach().cpu().clone()
+        for name, tensor in model.state_dict().items() if name not in frozen
+    }
+    self.requests.put((step, state))
+    self.num_pending += 1
+
+  def poll(self, block=False, max_pending=0):
+    """Get finished evaluations as a list of (step, results, pred_dict).
+
+        Args:
+            block (bool): Wait until at most `max_pending` evaluations are
+                still pending.
+            max_pending (int): Number of evaluations that may stay pending
+                when `block` is set.
+
+        Raises:
+            RuntimeError: If an evaluation failed or the evaluation process
+                exited.
+        """
+    finished = []
+    while self.num_pending > 0:
+      wait = block and self.num_pending > max_pending
+      try:
+        result = self.results.get(block=wait, timeout=self.poll_interval)
+      except queue.Empty:
+        if not wait:
+          break
+        if not self.process.is_alive():
+          raise RuntimeError(
+              'Evaluation process exited with code {} and {} evaluations '
+              'pending'.format(self.process.exitcode, self.num_pending))
+        continue
+      self.num_pending -= 1
+      step, results, error = result
+      if results is None:
+        raise RuntimeError('Evaluation at step {} failed:\n{}'.format(
+            step, error))
+      finished.append(result)
+
+    return finished
+
+  def close(self):
+    """Stop the evaluation process."""
+    if self.process.is_alive():
+      self.requests.put(None)
+    self.process.join()
+
+
+def run_eval_worker(args, requests, results):
+  """Main loop of the evaluation process started by `AsyncEvaluator`.
+
+    Each request gets a result of (step, results, pred_dict), or
+    (step, None, traceback) if evaluation failed.
+    """
+  try:
+    device = torch.device(args.eval_device)
+    word_vectors = util.torch_from_json(args.word_emb_file)
+    model = BiDAF(word_vectors=word_vectors, hidden_size=args.hidden_size)
+    model = model.to(device)
+
+    dev_dataset = SQuAD(args.dev_record_file, args.use_squad_v2)
+    if args.num_dev_samples:
+      dev_indices = range(args.num_dev_samples)
+    else:
+      dev_indices = None
+    dev_loader = data.DataLoader(
+        dev_dataset,
+        batch_sampler=util.ContextGroupedBatchSampler(
+            dev_dataset,
+            args.batch_size,
+            indices=dev_indices,
+            max_tokens=args.max_tokens,
+            with_questions=args.max_tokens_with_questions),
+        num_workers=args.num_workers,
+        collate_fn=partial(collate_fn, group_contexts=True),
+        pin_memory=device.type == 'cuda')
+    dev_eval = util.load_eval_store(args.dev_eval_store, args.dev_eval_file)
+  except Exception:
+    # Fail the first request, then exit so the trainer stops waiting
+    request = requests.get()
+    if request is not None:
+      results.put((request[0], None, traceback.format_exc()))
+    return
+
+  while True:
+    request = requests.get()
+    if request is None:
+      break
+    step, state = request
+    try:
+      model_state = model.state_dict()
+      model_state.update(state)
+      model.load_state_dict(model_state)
+      dev_results, pred_dict = evaluate(
+          model,
+          dev_loader,
+          device,
+          dev_eval,
+          args.max_ans_len,
+          args.use_squad_v2,
+          show_progress=False)
+    except Exception:
+      results.put((step, None, traceback.format_exc()))
+      continue
+    results.put((step, dev_results, pred_dict))
+
+
 if __name__ == '__main__':
-  main(get_train_args())
+  args_ = get_train_args()
+  if args_.benchmark:
+    benchmark(args_)
+  else:
+    main(args_)
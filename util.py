@@ -3,20 +3,32 @@
 Author:
     Chris Chute (chute@stanford.edu)
 """
+import copy
+import csv
+import functools
+import hashlib
+import heapq
+import io
+import itertools
 import logging
 import os
 import queue
+import random
 import re
 import shutil
 import string
+import time
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.data as data
 import tqdm
 import numpy as np
 import ujson as json
 
-from collections import Counter
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from eval_store import save_eval_store
 
 
 class SQuAD(data.Dataset):
@@ -36,6 +48,12 @@ class SQuAD(data.Dataset):
         - y2: Index of word in the context where the answer ends.
             -1 if no answer.
         - id: ID of the example.
+        - ctx_idx: Index of the example's context. Questions about the same
+            paragraph share the same context index.
+
+    Contexts are stored once per paragraph and looked up through `ctx_idxs`.
+    Record files written before contexts were de-duplicated (i.e., with one
+    context row per question) are still supported.
 
     Args:
         data_path (str): Path to .npz file containing pre-processed dataset.
@@ -54,22 +72,34 @@ class SQuAD(data.Dataset):
         dataset['ques_char_idxs']).long()
     self.y1s = torch.from_numpy(dataset['y1s']).long()
     self.y2s = torch.from_numpy(dataset['y2s']).long()
+    if 'ctx_idxs' in dataset:
+      self.ctx_idxs = torch.from_numpy(dataset['ctx_idxs']).long()
+    else:
+      # One context row per question
+      self.ctx_idxs = torch.arange(self.question_idxs.size(0))
 
     if use_v2:
       # SQuAD 2.0: Use index 0 for no-answer token (token 1 = OOV)
-      batch_size, c_len, w_len = self.context_char_idxs.size()
-      ones = torch.ones((batch_size, 1), dtype=torch.int64)
+      num_contexts, c_len, w_len = self.context_char_idxs.size()
+      num_questions = self.question_idxs.size(0)
+      ones = torch.ones((num_contexts, 1), dtype=torch.int64)
       self.context_idxs = torch.cat((ones, self.context_idxs), dim=1)
+      ones = torch.ones((num_questions, 1), dtype=torch.int64)
       self.question_idxs = torch.cat((ones, self.question_idxs), dim=1)
 
-      ones = torch.ones((batch_size, 1, w_len), dtype=torch.int64)
+      ones = torch.ones((num_contexts, 1, w_len), dtype=torch.int64)
       self.context_char_idxs = torch.cat((ones, self.context_char_idxs), dim=1)
+      ones = torch.ones((num_questions, 1, w_len), dtype=torch.int64)
       self.question_char_idxs = torch.cat((ones, self.question_char_idxs),
                                           dim=1)
 
       self.y1s += 1
       self.y2s += 1
 
+    # Unpadded lengths, for batching by token count
+    self.context_lens = (self.context_idxs != 0).sum(-1)
+    self.question_lens = (self.question_idxs != 0).sum(-1)
+
     # SQuAD 1.1: Ignore no-answer examples
     self.ids = torch.from_numpy(dataset['ids']).long()
     self.valid_idxs = [
@@ -79,9 +109,10 @@ class SQuAD(data.Dataset):
 
   def __getitem__(self, idx):
     idx = self.valid_idxs[idx]
-    example = (self.context_idxs[idx], self.context_char_idxs[idx],
+    ctx_idx = self.ctx_idxs[idx]
+    example = (self.context_idxs[ctx_idx], self.context_char_idxs[ctx_idx],
                self.question_idxs[idx], self.question_char_idxs[idx],
-               self.y1s[idx], self.y2s[idx], self.ids[idx])
+               self.y1s[idx], self.y2s[idx], self.ids[idx], ctx_idx)
 
     return example
 
@@ -89,19 +120,153 @@ class SQuAD(data.Dataset):
     return len(self.valid_idxs)
 
 
-def collate_fn(examples):
+class ContextGroupedBatchSampler(data.Sampler):
+  """Batch sampler that keeps questions about the same paragraph together.
+
+    Questions are grouped by context index, and the groups (not the individual
+    questions) are shuffled. Batches are then cut from the grouped order, so
+    every batch still has exactly `batch_size` examples (except possibly the
+    last one) but contains only a few distinct contexts. Together with
+    `collate_fn(..., group_contexts=True)` this lets the model encode each
+    paragraph once per batch.
+
+    If `max_tokens` is set, batches are instead cut so that the number of
+    padded context tokens, `len(batch) * max_context_len`, stays within
+    `max_tokens`, so batches of short paragraphs hold more questions. A
+    single example longer than the budget still gets a batch of its own.
+
+    Args:
+        dataset (SQuAD): Dataset to sample from.
+        batch_size (int): Number of questions per batch.
+        shuffle (bool): Shuffle the order of the paragraphs every epoch.
+        indices (list): Optional subset of dataset indices to sample from.
+        max_tokens (int): Padded token budget per batch. Zero means cut
+            batches by `batch_size`.
+        with_questions (bool): Count padded question tokens towards
+            `max_tokens` too.
+    """
+
+  def __init__(self,
+               dataset,
+               batch_size,
+               shuffle=False,
+               indices=None,
+               max_tokens=0,
+               with_questions=False):
+    if indices is None:
+      indices = range(len(dataset))
+    self.batch_size = batch_size
+    self.shuffle = shuffle
+    self.max_tokens = max_tokens
+
+    # Group dataset indices by context, keeping the original order
+    groups = OrderedDict()
+    for idx in indices:
+      ctx_idx = dataset.ctx_idxs[dataset.valid_idxs[idx]].item()
+      groups.setdefault(ctx_idx, []).append(idx)
+    self.groups = [torch.tensor(g, dtype=torch.int64) for g in groups.values()]
+    self.num_samples = sum(len(g) for g in self.groups)
+
+    if max_tokens:
+      # Lengths by dataset index
+      valid_idxs = torch.tensor(dataset.valid_idxs, dtype=torch.int64)
+      self.c_lens = dataset.context_lens[dataset.ctx_idxs[valid_idxs]]
+      self.q_lens = dataset.question_lens[valid_idxs] if with_questions \
+          else torch.zeros_like(self.c_lens)
+      self.num_batches = len(self._split(torch.cat(self.groups)))
+    else:
+      self.num_batches = \
+          (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    self.order = None
+    self.start = 0
+    self.resume_state = None
+
+  def _split(self, order):
+    """Cut `order` into a list of batches."""
+    if not self.max_tokens:
+      return order.split(self.batch_size)
+
+    batches = []
+    start = max_c_len = max_q_len = 0
+    c_lens = self.c_lens[order].tolist()
+    q_lens = self.q_lens[order].tolist()
+    for i, (c_len, q_len) in enumerate(zip(c_lens, q_lens)):
+      new_max_c_len = max(max_c_len, c_len)
+      new_max_q_len = max(max_q_len, q_len)
+      num_tokens = (i + 1 - start) * (new_max_c_len + new_max_q_len)
+      if i > start and num_tokens > self.max_tokens:
+        batches.append(order[start:i])
+        start = i
+        new_max_c_len, new_max_q_len = c_len, q_len
+      max_c_len, max_q_len = new_max_c_len, new_max_q_len
+    if start < len(order):
+      batches.append(order[start:])
+
+    return batches
+
+  def __iter__(self):
+    if self.resume_state is not None:
+      # Continue the epoch that was interrupted
+      self.order = self.resume_state['order']
+      self.start = self.resume_state['position']
+      self.resume_state = None
+    else:
+      if self.shuffle:
+        group_order = torch.randperm(len(self.groups)).tolist()
+      else:
+        group_order = range(len(self.groups))
+      self.order = torch.cat([self.groups[i] for i in group_order])
+      self.start = 0
+    batches = self._split(self.order)
+    self.num_batches = len(batches)
+    batches = batches[self.start:]
+
+    return iter([batch.tolist() for batch in batches])
+
+  def __len__(self):
+    """Number of batches in the current epoch. With `max_tokens` this
+        depends on the paragraph order, so before the first epoch it is the
+        number for the unshuffled order.
+        """
+    return self.num_batches
+
+  def state_dict(self, num_batches):
+    """Get the state of the current epoch.
+
+        Args:
+            num_batches (int): Number of batches consumed from the current
+                iterator. The DataLoader may have prefetched more than that.
+        """
+    return {'order': self.order, 'position': self.start + num_batches}
+
+  def load_state_dict(self, state_dict):
+    """Make the next iterator resume the epoch saved in `state_dict`."""
+    # Checkpoints may be loaded onto a GPU, but lengths are indexed on CPU
+    self.resume_state = {
+        'order': state_dict['order'].cpu(),
+        'position': state_dict['position']
+    }
+
+
+def collate_fn(examples, group_contexts=False):
   """Create batch tensors from a list of individual examples returned
     by `SQuAD.__getitem__`. Merge examples of different length by padding
     all examples to the maximum length in the batch.
 
     Args:
         examples (list): List of tuples of the form (context_idxs, context_char_idxs,
-        question_idxs, question_char_idxs, y1s, y2s, ids).
+        question_idxs, question_char_idxs, y1s, y2s, ids, ctx_idxs).
+        group_contexts (bool): Merge each distinct context once, and return
+            a map from questions to rows of the context tensors.
 
     Returns:
         examples (tuple): Tuple of tensors (context_idxs, context_char_idxs, question_idxs,
-        question_char_idxs, y1s, y2s, ids). All of shape (batch_size, ...), where
+        question_char_idxs, y1s, y2s, ids, c_map). All of shape (batch_size, ...), where
         the remaining dimensions are the maximum length of examples in the input.
+        If `group_contexts` is set, the context tensors have shape
+        (num_contexts, ...) and `c_map` of shape (batch_size,) gives the
+        context row of each question. Otherwise `c_map` is None.
 
     Adapted from:
         https://github.com/yunjey/seq2seq-dataloader
@@ -130,7 +295,19 @@ def collate_fn(examples):
   # Group by tensor type
   context_idxs, context_char_idxs, \
       question_idxs, question_char_idxs, \
-      y1s, y2s, ids = zip(*examples)
+      y1s, y2s, ids, ctx_idxs = zip(*examples)
+
+  if group_contexts:
+    # Keep the first occurrence of each context
+    firsts = OrderedDict()  # Context index -> first example using it
+    for i, ctx_idx in enumerate(ctx_idxs):
+      firsts.setdefault(ctx_idx.item(), i)
+    rows = {ctx_idx: row for row, ctx_idx in enumerate(firsts)}
+    c_map = merge_0d([rows[ctx_idx.item()] for ctx_idx in ctx_idxs])
+    context_idxs = [context_idxs[i] for i in firsts.values()]
+    context_char_idxs = [context_char_idxs[i] for i in firsts.values()]
+  else:
+    c_map = None
 
   # Merge into batch tensors
   context_idxs = merge_1d(context_idxs)
@@ -142,7 +319,89 @@ def collate_fn(examples):
   ids = merge_0d(ids)
 
   return (context_idxs, context_char_idxs, question_idxs, question_char_idxs,
-          y1s, y2s, ids)
+          y1s, y2s, ids, c_map)
+
+
+# Fields of a `collate_fn` batch used by the model and the loss
+BATCH_DEVICE_FIELDS = (0, 2, 4, 5, 7)
+
+
+class DevicePrefetcher:
+  """Iterate over batches with their tensors already on `device`.
+
+    While the caller runs a step on one batch, the host-to-device copies for
+    the next batch are issued on a side CUDA stream, so transfers overlap
+    with compute. Build the underlying `DataLoader` with `pin_memory=True` so
+    the copies can be asynchronous. On CPU the batches are passed through.
+
+    Args:
+        batches (iterable): Batches of tensors, e.g. a `DataLoader` or an
+            iterator over one.
+        device (torch.device): Device to move the batches to.
+        fields (tuple): Positions in each batch to move. Other fields stay
+            on the host. Defaults to all tensor fields.
+
+    Attributes:
+        wait_time (float): Seconds the caller waited for the latest batch.
+        total_wait_time (float): Seconds spent waiting in this pass.
+    """
+
+  def __init__(self, batches, device, fields=None):
+    self.batches = batches
+    self.device = torch.device(device)
+    self.fields = fields
+    self.wait_time = 0.
+    self.total_wait_time = 0.
+
+  def __len__(self):
+    return len(self.batches)
+
+  def _to_device(self, batch):
+    batch = list(batch)
+    fields = range(len(batch)) if self.fields is None else self.fields
+    for i in fields:
+      if torch.is_tensor(batch[i]):
+        batch[i] = batch[i].to(self.device, non_blocking=True)
+
+    return batch
+
+  def _load(self, batches, stream):
+    try:
+      batch = next(batches)
+    except StopIteration:
+      return None
+    if stream is None:
+      return self._to_device(batch)
+    with torch.cuda.stream(stream):
+      return self._to_device(batch)
+
+  def __iter__(self):
+    batches = iter(self.batches)
+    if self.device.type == 'cuda':
+      stream = torch.cuda.Stream(self.device)
+      current_stream = torch.cuda.current_stream(self.device)
+    else:
+      stream = None
+    self.total_wait_time = 0.
+
+    tic = time.perf_counter()
+    next_batch = self._load(batches, stream)
+    while next_batch is not None:
+      batch = next_batch
+      if stream is not None:
+        # Copies must finish before the step uses the batch, and its memory
+        # must not be reused by the side stream while the step runs
+        current_stream.wait_stream(stream)
+        for tensor in batch:
+          if torch.is_tensor(tensor) and tensor.is_cuda:
+            tensor.record_stream(current_stream)
+
+      # Start copying the following batch before handing this one out
+      next_batch = self._load(batches, stream)
+      self.wait_time = time.perf_counter() - tic
+      self.total_wait_time += self.wait_time
+      yield tuple(batch)
+      tic = time.perf_counter()
 
 
 class AverageMeter:
@@ -173,9 +432,351 @@ class AverageMeter:
     self.sum += val * num_samples
     self.avg = self.sum / self.count
 
+  def state_dict(self):
+    return {'avg': self.avg, 'sum': self.sum, 'count': self.count}
+
+  def load_state_dict(self, state_dict):
+    self.avg = state_dict['avg']
+    self.sum = state_dict['sum']
+    self.count = state_dict['count']
+
+
+class _NullPhase:
+  """Context manager that does nothing, used when timing is disabled."""
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return False
+
+
+class _TimedPhase:
+  """Context manager that adds its wall time to a `PhaseTimer`."""
+
+  def __init__(self, timer, name):
+    self.timer = timer
+    self.name = name
+    self.tic = None
+
+  def __enter__(self):
+    self.timer.synchronize()
+    self.tic = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.timer.synchronize()
+    self.timer.add(self.name, time.perf_counter() - self.tic)
+    return False
+
+
+class PhaseTimer:
+  """Record wall time per phase of a training step and throughput stats.
+
+    Stats are aggregated over `window` steps and written to TensorBoard
+    under `perf/`. On CUDA the device is synchronized around each phase so
+    that asynchronous kernels are charged to the phase that launched them,
+    which slows training down a little. When disabled every method returns
+    immediately.
+
+    Args:
+        device (torch.device): Device the model runs on.
+        window (int): Number of steps to aggregate over. 0 disables timing.
+    """
+  _null_phase = _NullPhase()
+
+  def __init__(self, device, window=100):
+    self.device = torch.device(device)
+    self.window = window
+    self.enabled = window > 0
+    self.use_cuda = self.enabled and self.device.type == 'cuda'
+    self.reset()
+
+  def reset(self):
+    """Start a new window."""
+    self.times = OrderedDict()
+    self.num_steps = 0
+    self.num_examples = 0
+    self.num_tokens = 0
+    self.num_padded = 0
+    self.start = time.perf_counter()
+    if self.use_cuda and hasattr(torch.cuda, 'reset_peak_memory_stats'):
+      torch.cuda.reset_peak_memory_stats(self.device)
+
+  def synchronize(self):
+    if self.use_cuda:
+      torch.cuda.synchronize(self.device)
+
+  def phase(self, name):
+    """Context manager that times the enclosed code as phase `name`."""
+    if not self.enabled:
+      return self._null_phase
+    return _TimedPhase(self, name)
+
+  def add(self, name, seconds):
+    """Add time measured elsewhere, e.g. waiting for data, to phase `name`."""
+    if self.enabled:
+      self.times[name] = self.times.get(name, 0.) + seconds
+
+  def count(self, cw_idxs, qw_idxs, c_map=None):
+    """Record a step over a batch of questions.
+
+        Tokens are counted per question, so a context shared by several
+        questions in a batch from `collate_fn(..., group_contexts=True)`
+        counts once for each of them. Counts stay on the device until
+        `write`, so this does not synchronize.
+
+        Args:
+            cw_idxs (torch.Tensor): Padded context word indices.
+            qw_idxs (torch.Tensor): Padded question word indices.
+            c_map (torch.Tensor): Optional map from questions to rows of
+                `cw_idxs`.
+        """
+    if not self.enabled:
+      return
+    batch_size, c_len = qw_idxs.size(0), cw_idxs.size(1)
+    c_tokens = (cw_idxs != 0).sum(-1)
+    if c_map is not None:
+      c_tokens = c_tokens[c_map]
+    self.num_steps += 1
+    self.num_examples += batch_size
+    self.num_tokens = self.num_tokens \
+        + c_tokens.sum() + (qw_idxs != 0).sum()
+    self.num_padded += batch_size * c_len + qw_idxs.numel()
+
+  def write(self, tbx, step):
+    """Write stats to TensorBoard and start a new window if it is full.
+
+        Args:
+            tbx (tensorboardX.SummaryWriter): Summary writer.
+            step (int): Number of examples seen so far during training.
+        """
+    if not self.enabled or self.num_steps < self.window:
+      return
+    self.synchronize()
+    elapsed = time.perf_counter() - self.start
+    num_tokens = float(self.num_tokens)
+    for name, seconds in self.times.items():
+      tbx.add_scalar('perf/{}_ms'.format(name),
+                     1000. * seconds / self.num_steps, step)
+    tbx.add_scalar('perf/examples_per_sec', self.num_examples / elapsed, step)
+    tbx.add_scalar('perf/examples_per_step',
+                   self.num_examples / self.num_steps, step)
+    tbx.add_scalar('perf/tokens_per_sec', num_tokens / elapsed, step)
+    tbx.add_scalar('perf/padding_ratio',
+                   1. - num_tokens / max(self.num_padded, 1), step)
+    if self.use_cuda:
+      tbx.add_scalar('perf/peak_mem_mb',
+                     torch.cuda.max_memory_allocated(self.device) / 2**20,
+                     step)
+    self.reset()
+
+
+def record_scope(name):
+  """Context manager that labels the enclosed code `name` in profiles."""
+  record_function = getattr(torch.autograd.profiler, 'record_function', None)
+  if record_function is None:
+    return _NullPhase()
+  return record_function(name)
+
+
+def profiled(name):
+  """Decorator that labels every call of a function `name` in profiles."""
+
+  def decorator(fn):
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+      with record_scope(name):
+        return fn(*args, **kwargs)
+
+    return wrapper
+
+  return decorator
+
+
+class ProfilerWindow:
+  """Run the PyTorch profiler for a window of steps.
+
+    Call `step` at the end of every step. Profiling covers steps
+    `[start_step, start_step + num_steps)`, counted from 0. The forward pass
+    of each BiDAF submodule is labelled `BiDAF.<name>`. When the window ends,
+    a Chrome trace (`trace.json`) and a table of the most expensive
+    operators (`profile.txt`) are written to `save_dir`.
+
+    Args:
+        save_dir (str): Directory to write the trace and table to.
+        start_step (int): Index of the first step to profile.
+        num_steps (int): Number of steps to profile. 0 disables profiling.
+        device (torch.device): Device the model runs on.
+        model (torch.nn.Module): Model whose submodules should be labelled.
+        log (logging.Logger): Optional logger for printing information.
+    """
+  module_names = ('emb', 'enc', 'att', 'mod', 'out')
+
+  def __init__(self,
+               save_dir,
+               start_step,
+               num_steps,
+               device,
+               model=None,
+               log=None):
+    self.save_dir = save_dir
+    self.start_step = start_step
+    self.end_step = start_step + num_steps
+    self.use_cuda = torch.device(device).type == 'cuda'
+    self.model = getattr(model, 'module', model)
+    self.log = log
+    self.enabled = num_steps > 0
+    self.num_steps = 0
+    self.profiler = None
+    self.hooks = []
+    self.scopes = []
+    if self.enabled and not hasattr(torch, 'profiler'):
+      raise RuntimeError('Profiling requires torch.profiler (PyTorch 1.8.1+)')
+    if self.enabled and self.start_step == 0:
+      self._start()
+
+  def _print(self, message):
+    if self.log is not None:
+      self.log.info(message)
+
+  def _start(self):
+    self._print('Profiling steps {} to {}...'.format(self.start_step,
+                                                     self.end_step - 1))
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if self.use_cuda:
+      activities.append(torch.profiler.ProfilerActivity.CUDA)
+    self.profiler = torch.profiler.profile(
+        activities=activities, record_shapes=True, profile_memory=True)
+    self.profiler.__enter__()
+
+    if self.model is not None:
+      for name in self.module_names:
+        module = getattr(self.model, name, None)
+        if module is None:
+          continue
+        self.hooks.append(
+            module.register_forward_pre_hook(
+                self._enter_scope('BiDAF.{}'.format(name))))
+        self.hooks.append(module.register_forward_hook(self._exit_scope))
+
+  def _enter_scope(self, name):
+
+    def hook(module, inputs):
+      scope = record_scope(name)
+      scope.__enter__()
+      self.scopes.append(scope)
+
+    return hook
+
+  def _exit_scope(self, module, inputs, outputs):
+    self.scopes.pop().__exit__(None, None, None)
+
+  def _stop(self):
+    for hook in self.hooks:
+      hook.remove()
+    self.hooks = []
+    if self.use_cuda:
+      torch.cuda.synchronize()
+    self.profiler.__exit__(None, None, None)
+
+    trace_path = os.path.join(self.save_dir, 'trace.json')
+    self.profiler.export_chrome_trace(trace_path)
+    sort_by = 'cuda_time_total' if self.use_cuda else 'cpu_time_total'
+    table = self.profiler.key_averages().table(sort_by=sort_by, row_limit=50)
+    table_path = os.path.join(self.save_dir, 'profile.txt')
+    with open(table_path, 'w') as fh:
+      fh.write(table)
+    self._print('Saved profile to {} and {}'.format(trace_path, table_path))
+    self.profiler = None
+
+  def step(self):
+    """Mark the end of a step, starting or stopping the profiler."""
+    if not self.enabled:
+      return
+    self.num_steps += 1
+    if self.num_steps == self.start_step:
+      self._start()
+    elif self.num_steps == self.end_step and self.profiler is not None:
+      self._stop()
+
+  def close(self):
+    """Stop the profiler if the window is still open."""
+    if self.profiler is not None:
+      self._stop()
+
+
+class TensorLRUCache:
+  """Least-recently-used cache of tensors bounded by total memory.
+
+    Args:
+        max_bytes (int): Evict least-recently-used entries once the tensors
+            in the cache take up more than this many bytes.
+    """
+
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.num_bytes = 0
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, key):
+    """Get the tensor cached under `key`, or None if it is not cached."""
+    tensor = self.entries.get(key)
+    if tensor is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+      self.entries.move_to_end(key)
+
+    return tensor
+
+  def put(self, key, tensor):
+    """Cache `tensor` under `key`, evicting old entries to make room."""
+    size = tensor.numel() * tensor.element_size()
+    if size > self.max_bytes:
+      # Would evict everything and still not fit
+      return
+
+    if key in self.entries:
+      old = self.entries.pop(key)
+      self.num_bytes -= old.numel() * old.element_size()
+    self.entries[key] = tensor
+    self.num_bytes += size
+
+    while self.num_bytes > self.max_bytes:
+      _, old = self.entries.popitem(last=False)
+      self.num_bytes -= old.numel() * old.element_size()
+      self.evictions += 1
+
+  def clear(self):
+    """Remove all entries. Statistics are kept."""
+    self.entries.clear()
+    self.num_bytes = 0
+
+  def stats(self):
+    """Get hit/miss statistics and memory usage of the cache."""
+    lookups = self.hits + self.misses
+    return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': self.hits / lookups if lookups else 0.,
+        'evictions': self.evictions,
+        'entries': len(self.entries),
+        'bytes': self.num_bytes,
+    }
+
 
 class EMA:
   """Exponential moving average of model parameters.
+
+    Shadow weights live in one flat buffer, so each update is a single fused
+    multi-tensor operation. `assign` and `resume` swap tensor pointers rather
+    than copying values.
+
     Args:
         model (torch.nn.Module): Model with parameters whose EMA will be kept.
         decay (float): Decay rate for exponential moving average.
@@ -183,22 +784,30 @@ class EMA:
 
   def __init__(self, model, decay):
     self.decay = decay
-    self.shadow = {}
-    self.original = {}
+    self.original = None
 
     # Register model parameters
+    self.params = [p for p in model.parameters() if p.requires_grad]
+    self.flat_shadow = torch.cat([p.data.reshape(-1) for p in self.params])
+    self.shadow = OrderedDict()
+    offset = 0
     for name, param in model.named_parameters():
       if param.requires_grad:
-        self.shadow[name] = param.data.clone()
+        numel = param.numel()
+        self.shadow[name] = \
+            self.flat_shadow[offset:offset + numel].view_as(param)
+        offset += numel
+    self.shadow_list = list(self.shadow.values())
 
   def __call__(self, model, num_updates):
     decay = min(self.decay, (1.0 + num_updates) / (10.0 + num_updates))
-    for name, param in model.named_parameters():
-      if param.requires_grad:
-        assert name in self.shadow
-        new_average = \
-            (1.0 - decay) * param.data + decay * self.shadow[name]
-        self.shadow[name] = new_average.clone()
+    with torch.no_grad():
+      if hasattr(torch, '_foreach_mul_'):
+        torch._foreach_mul_(self.shadow_list, decay)
+        torch._foreach_add_(self.shadow_list, self.params, alpha=1.0 - decay)
+      else:
+        for shadow, param in zip(self.shadow_list, self.params):
+          shadow.mul_(decay).add_(param, alpha=1.0 - decay)
 
   def assign(self, model):
     """Assign exponential moving average of parameter values to the
@@ -206,11 +815,9 @@ class EMA:
         Args:
             model (torch.nn.Module): Model to assign parameter values.
         """
-    for name, param in model.named_parameters():
-      if param.requires_grad:
-        assert name in self.shadow
-        self.original[name] = param.data.clone()
-        param.data = self.shadow[name]
+    self.original = [param.data for param in self.params]
+    for param, shadow in zip(self.params, self.shadow_list):
+      param.data = shadow
 
   def resume(self, model):
     """Restore original parameters to a model. That is, put back
@@ -218,10 +825,32 @@ class EMA:
         Args:
             model (torch.nn.Module): Model to assign parameter values.
         """
-    for name, param in model.named_parameters():
-      if param.requires_grad:
-        assert name in self.shadow
-        param.data = self.original[name]
+    for param, original in zip(self.params, self.original):
+      param.data = original
+    self.original = None
+
+  def state_dict(self):
+    """Get the shadow weights. If the averages are currently assigned to
+        the model, also include the original parameter values.
+        """
+    state_dict = {'shadow': self.flat_shadow}
+    if self.original is not None:
+      state_dict['original'] = torch.cat(
+          [original.reshape(-1) for original in self.original])
+
+    return state_dict
+
+  def load_state_dict(self, state_dict):
+    """Restore shadow weights, and original parameter values if saved."""
+    self.flat_shadow.copy_(state_dict['shadow'])
+    if 'original' in state_dict:
+      offset = 0
+      with torch.no_grad():
+        for param in self.params:
+          numel = param.numel()
+          param.copy_(state_dict['original'][offset:offset + numel]
+                      .view_as(param))
+          offset += numel
 
 
 class CheckpointSaver:
@@ -229,7 +858,8 @@ class CheckpointSaver:
 
     Save the best checkpoints as measured by a metric value passed into the
     `save` method. Overwrite checkpoints with better checkpoints once
-    `max_checkpoints` have been saved.
+    `max_checkpoints` have been saved. Checkpoints are written by a
+    background thread; call `close` to wait for outstanding writes.
 
     Args:
         save_dir (str): Directory to save checkpoints.
@@ -240,6 +870,11 @@ class CheckpointSaver:
             the metric value passed in via `save`. Otherwise, best checkpoint
             minimizes the metric.
         log (logging.Logger): Optional logger for printing information.
+        frozen_files (dict): Maps names of frozen parameters (e.g., the
+            pre-trained word vectors) to the files they were loaded from.
+            Frozen parameters are not written to checkpoints. Instead each
+            checkpoint stores a content hash and the file, which
+            `load_model` uses to restore them.
     """
 
   def __init__(self,
@@ -247,7 +882,8 @@ class CheckpointSaver:
                max_checkpoints,
                metric_name,
                maximize_metric=False,
-               log=None):
+               log=None,
+               frozen_files=None):
     super(CheckpointSaver, self).__init__()
 
     self.save_dir = save_dir
@@ -257,6 +893,13 @@ class CheckpointSaver:
     self.best_val = None
     self.ckpt_paths = queue.PriorityQueue()
     self.log = log
+    self.frozen_files = frozen_files or {}
+    self.frozen_digests = {}
+    self.host_buffers = {}
+    self.unscored = {}  # Step -> path of checkpoints awaiting a metric
+    self.writer = ThreadPoolExecutor(max_workers=1)
+    self.writes = {}  # Checkpoint path -> future of its write
+    self.pending = []  # Futures whose errors have not been checked
     self._print('Saver will {}imize {}...'.format(
         'max' if maximize_metric else 'min', metric_name))
 
@@ -282,33 +925,101 @@ class CheckpointSaver:
     if self.log is not None:
       self.log.info(message)
 
-  def save(self, step, model, metric_val, device):
+  def _snapshot(self, name, tensor):
+    """Copy `tensor` into a preallocated host buffer named `name`."""
+    buf = self.host_buffers.get(name)
+    if buf is None or buf.size() != tensor.size() or buf.dtype != tensor.dtype:
+      buf = torch.empty(tensor.size(), dtype=tensor.dtype)
+      if tensor.is_cuda:
+        buf = buf.pin_memory()
+      self.host_buffers[name] = buf
+    buf.copy_(tensor.detach(), non_blocking=True)
+
+    return buf
+
+  def _snapshot_state(self, name, obj):
+    """Copy all tensors in a nested dict/list/tuple into host buffers."""
+    if torch.is_tensor(obj):
+      return self._snapshot(name, obj)
+    if isinstance(obj, dict):
+      return type(obj)(
+          (key, self._snapshot_state('{}.{}'.format(name, key), val))
+          for key, val in obj.items())
+    if isinstance(obj, (list, tuple)):
+      return type(obj)(self._snapshot_state('{}.{}'.format(name, i), val)
+                       for i, val in enumerate(obj))
+    return copy.deepcopy(obj)
+
+  def save(self, step, model, metric_val, device=None, train_state=None):
     """Save model parameters to disk.
 
+        Parameters are copied into host buffers before returning, and the
+        checkpoint is written to disk on a background thread.
+
         Args:
             step (int): Total number of examples seen during training so far.
             model (torch.nn.DataParallel): Model to save.
             metric_val (float): Determines whether checkpoint is best so far.
-            device (torch.device): Device where model resides.
+                If None, the metric is reported later through `report`.
+            device (torch.device): Ignored. The model is no longer moved off
+                its device to be saved.
+            train_state (dict): Optional state needed to resume training
+                exactly (optimizer, EMA, RNG, data order, ...).
         """
+    # Host buffers are reused, so the previous write must finish first
+    self.wait()
+
+    # Save trainable parameters and buffers, and refer to frozen parameters
+    frozen_state = {}
+    for name, param in model.named_parameters():
+      if not param.requires_grad:
+        if name not in self.frozen_digests:
+          self.frozen_digests[name] = tensor_digest(param)
+        frozen_state[name] = {
+            'sha1': self.frozen_digests[name],
+            'path': self.frozen_files.get(name)
+        }
+    model_state = OrderedDict(
+        (name, self._snapshot(name, tensor))
+        for name, tensor in model.state_dict().items()
+        if name not in frozen_state)
+    if train_state is not None:
+      train_state = self._snapshot_state('train_state', train_state)
+    if torch.cuda.is_available():
+      torch.cuda.synchronize()
     ckpt_dict = {
         'model_name': model.__class__.__name__,
-        'model_state': model.cpu().state_dict(),
+        'model_state': model_state,
+        'frozen_state': frozen_state,
+        'train_state': train_state,
         'step': step
     }
-    model.to(device)
 
     checkpoint_path = os.path.join(self.save_dir,
                                    'step_{}.pth.tar'.format(step))
-    torch.save(ckpt_dict, checkpoint_path)
-    self._print('Saved checkpoint: {}'.format(checkpoint_path))
+    self.writes[checkpoint_path] = self.writer.submit(self._write, ckpt_dict,
+                                                      checkpoint_path)
+    self.pending.append(self.writes[checkpoint_path])
+    if metric_val is None:
+      # Metric will be reported later through `report`
+      self.unscored[step] = checkpoint_path
+    else:
+      self._rank(step, checkpoint_path, metric_val)
 
-    if self.is_best(metric_val):
-      # Save the best model
+  def report(self, step, metric_val):
+    """Report the metric of a checkpoint saved with `metric_val=None`.
+
+        Args:
+            step (int): Step passed to `save`.
+            metric_val (float): Determines whether checkpoint is best so far.
+        """
+    self._rank(step, self.unscored.pop(step), metric_val)
+
+  def _rank(self, step, checkpoint_path, metric_val):
+    """Update the best checkpoint and remove the worst checkpoint."""
+    is_best = self.is_best(metric_val)
+    if is_best:
       self.best_val = metric_val
-      best_path = os.path.join(self.save_dir, 'best.pth.tar')
-      shutil.copy(checkpoint_path, best_path)
-      self._print('New best checkpoint at step {}...'.format(step))
 
     # Add checkpoint path to priority queue (lowest priority removed first)
     if self.maximize_metric:
@@ -319,8 +1030,50 @@ class CheckpointSaver:
     self.ckpt_paths.put((priority_order, checkpoint_path))
 
     # Remove a checkpoint if more than max_checkpoints have been saved
+    worst_ckpt = None
     if self.ckpt_paths.qsize() > self.max_checkpoints:
       _, worst_ckpt = self.ckpt_paths.get()
+
+    # Runs after the checkpoint itself has been written
+    self.pending.append(
+        self.writer.submit(self._update_files, step, checkpoint_path,
+                           self.writes.pop(checkpoint_path), is_best,
+                           worst_ckpt))
+
+  def _write(self, ckpt_dict, checkpoint_path):
+    """Write a checkpoint snapshot to disk. Runs on the writer thread."""
+    tmp_path = checkpoint_path + '.tmp'
+    try:
+      torch.save(ckpt_dict, tmp_path)
+      os.replace(tmp_path, checkpoint_path)
+    except BaseException:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+      raise
+    self._print('Saved checkpoint: {}'.format(checkpoint_path))
+
+  def _update_files(self, step, checkpoint_path, write, is_best, worst_ckpt):
+    """Link the best checkpoint and remove the worst one. Runs on the
+        writer thread.
+        """
+    # Do not link or prune around a checkpoint that failed to write
+    write.result()
+
+    if is_best:
+      # Save the best model
+      best_path = os.path.join(self.save_dir, 'best.pth.tar')
+      tmp_path = best_path + '.tmp'
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+      try:
+        os.link(checkpoint_path, tmp_path)
+      except OSError:
+        # File system does not support hard links
+        shutil.copy(checkpoint_path, tmp_path)
+      os.replace(tmp_path, best_path)
+      self._print('New best checkpoint at step {}...'.format(step))
+
+    if worst_ckpt is not None:
       try:
         os.remove(worst_ckpt)
         self._print('Removed checkpoint: {}'.format(worst_ckpt))
@@ -328,13 +1081,52 @@ class CheckpointSaver:
         # Avoid crashing if checkpoint has been removed or protected
         pass
 
+  def wait(self):
+    """Block until all checkpoints have been written to disk.
+
+        Raises:
+            Exception: The first error raised while writing, linking or
+                removing a checkpoint.
+        """
+    pending, self.pending = self.pending, []
+    for future in pending:
+      future.result()
+
+  def close(self):
+    """Finish writing checkpoints and stop the writer thread."""
+    self.wait()
+    self.writer.shutdown()
+
+
+def load_checkpoint(checkpoint_path, gpu_ids):
+  """Load a checkpoint dict from disk.
+
+    Args:
+        checkpoint_path (str): Path to checkpoint to load.
+        gpu_ids (list): GPU IDs for DataParallel.
+
+    Returns:
+        ckpt_dict (dict): Checkpoint with tensors on the main device.
+    """
+  device = 'cuda:{}'.format(gpu_ids[0]) if gpu_ids else 'cpu'
+  ckpt_dict = torch.load(checkpoint_path, map_location=device)
+
+  return ckpt_dict
+
 
 def load_model(model, checkpoint_path, gpu_ids, return_step=True):
   """Load model parameters from disk.
 
+    Frozen parameters saved by reference (see `CheckpointSaver`) are kept
+    from `model` if their contents match the checkpoint's hash, and are
+    otherwise reloaded from the file recorded in the checkpoint.
+
     Args:
-        model (torch.nn.DataParallel): Load parameters into this model.
-        checkpoint_path (str): Path to checkpoint to load.
+        model (torch.nn.DataParallel): Load parameters into this model. May
+            also be the bare model, e.g., to run on CPU when CUDA is
+            available.
+        checkpoint_path (str or dict): Path to checkpoint to load, or a
+            checkpoint dict returned by `load_checkpoint`.
         gpu_ids (list): GPU IDs for DataParallel.
         return_step (bool): Also return the step at which checkpoint was saved.
 
@@ -342,11 +1134,37 @@ def load_model(model, checkpoint_path, gpu_ids, return_step=True):
         model (torch.nn.DataParallel): Model loaded from checkpoint.
         step (int): Step at which checkpoint was saved. Only if `return_step`.
     """
-  device = 'cuda:{}'.format(gpu_ids[0]) if gpu_ids else 'cpu'
-  ckpt_dict = torch.load(checkpoint_path, map_location=device)
+  if isinstance(checkpoint_path, dict):
+    ckpt_dict = checkpoint_path
+  else:
+    ckpt_dict = load_checkpoint(checkpoint_path, gpu_ids)
+
+  # Checkpoints are saved from nn.DataParallel, so strip its prefix when
+  # loading into a bare model
+  def rename(name):
+    if not isinstance(model, nn.DataParallel) and name.startswith('module.'):
+      return name[len('module.'):]
+    return name
+
+  # Resolve frozen parameters that are stored by reference
+  model_state = OrderedDict(
+      (rename(name), tensor)
+      for name, tensor in ckpt_dict['model_state'].items())
+  current_state = model.state_dict()
+  for name, ref in ckpt_dict.get('frozen_state', {}).items():
+    name = rename(name)
+    tensor = current_state[name]
+    if tensor_digest(tensor) != ref['sha1']:
+      if ref['path'] is None:
+        raise ValueError('No file to restore frozen parameter {}'.format(name))
+      tensor = torch_from_json(ref['path'])
+      if tensor_digest(tensor) != ref['sha1']:
+        raise ValueError('Contents of {} do not match checkpoint'.format(
+            ref['path']))
+    model_state[name] = tensor
 
   # Build model, load parameters
-  model.load_state_dict(ckpt_dict['model_state'])
+  model.load_state_dict(model_state)
 
   if return_step:
     step = ckpt_dict['step']
@@ -355,6 +1173,47 @@ def load_model(model, checkpoint_path, gpu_ids, return_step=True):
   return model
 
 
+def get_rng_state():
+  """Get the state of all random number generators used in training.
+
+    The NumPy state is stored as a tensor and plain numbers, so checkpoints
+    holding it still load with `torch.load(..., weights_only=True)`.
+
+    Returns:
+        rng_state (dict): States of the Python, NumPy, PyTorch CPU and
+            (if available) CUDA generators.
+    """
+  _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+  rng_state = {
+      'python': random.getstate(),
+      'numpy': {
+          'keys': torch.from_numpy(keys.astype(np.int64)),
+          'pos': int(pos),
+          'has_gauss': int(has_gauss),
+          'cached_gaussian': float(cached_gaussian)
+      },
+      'torch': torch.get_rng_state()
+  }
+  if torch.cuda.is_available():
+    rng_state['cuda'] = torch.cuda.get_rng_state_all()
+
+  return rng_state
+
+
+def set_rng_state(rng_state):
+  """Restore random number generators from `get_rng_state`."""
+  random.setstate(rng_state['python'])
+  np_state = rng_state['numpy']
+  if isinstance(np_state, dict):
+    np_state = ('MT19937', np_state['keys'].cpu().numpy().astype(np.uint32),
+                np_state['pos'], np_state['has_gauss'],
+                np_state['cached_gaussian'])
+  np.random.set_state(np_state)
+  torch.set_rng_state(rng_state['torch'].cpu())
+  if 'cuda' in rng_state and torch.cuda.is_available():
+    torch.cuda.set_rng_state_all([state.cpu() for state in rng_state['cuda']])
+
+
 def get_available_devices():
   """Get IDs of all available GPUs.
 
@@ -377,10 +1236,16 @@ def masked_softmax(logits, mask, dim=-1, log_softmax=False):
   """Take the softmax of `logits` over given dimension, and set
     entries to 0 wherever `mask` is 0.
 
+    Masked logits are filled with a large negative value that fits the dtype
+    of `logits` (-1e30 overflows in half precision), so there are no
+    full-size float copies of the mask.
+
     Args:
         logits (torch.Tensor): Inputs to the softmax function.
-        mask (torch.Tensor): Same shape as `logits`, with 0 indicating
-            positions that should be assigned 0 probability in the output.
+        mask (torch.Tensor): Broadcastable to the shape of `logits`, with 0
+            indicating positions that should be assigned 0 probability in
+            the output. E.g., shape (batch_size, 1, q_len) for logits of
+            shape (batch_size, c_len, q_len).
         dim (int): Dimension over which to take softmax.
         log_softmax (bool): Take log-softmax rather than regular softmax.
             E.g., some PyTorch functions such as `F.nll_loss` expect log-softmax.
@@ -388,21 +1253,155 @@ def masked_softmax(logits, mask, dim=-1, log_softmax=False):
     Returns:
         probs (torch.Tensor): Result of taking masked softmax over the logits.
     """
-  mask = mask.type(torch.float32)
-  masked_logits = mask * logits + (1 - mask) * -1e30
+  fill_value = max(torch.finfo(logits.dtype).min, -1e30)
+  masked_logits = logits.masked_fill(mask == 0, fill_value)
   softmax_fn = F.log_softmax if log_softmax else F.softmax
   probs = softmax_fn(masked_logits, dim)
 
   return probs
 
 
-def visualize(tbx, pred_dict, eval_path, step, split, num_visuals):
+class EvalStore:
+  """Read-only eval info for a split, backed by flat arrays.
+
+    Supports the same lookups as the eval dict written by setup.py
+    (`store[id]`, `items()`), plus vectorized lookups over a batch of example
+    IDs. Normalized gold answers for `eval_dicts` are computed once and cached.
+
+    Args:
+        arrays (dict): Arrays written by `save_eval_store`.
+    """
+
+  def __init__(self, arrays):
+    self.ids = arrays['ids']
+    self.ctx_idxs = arrays['ctx_idxs']
+    self.spans = arrays['spans']
+    self.span_offsets = arrays['span_offsets']
+    self.context_text = arrays['context_text'].tobytes().decode('utf-8')
+    self.context_offsets = arrays['context_offsets']
+    self.question_text = arrays['question_text'].tobytes().decode('utf-8')
+    self.question_offsets = arrays['question_offsets']
+    self.uuid_text = arrays['uuid_text'].tobytes().decode('utf-8')
+    self.uuid_offsets = arrays['uuid_offsets']
+    self.answer_text = arrays['answer_text'].tobytes().decode('utf-8')
+    self.answer_offsets = arrays['answer_offsets']
+    self.answer_groups = arrays['answer_groups']
+    self._gold_answers = None
+
+  def rows(self, qa_ids):
+    """Get the rows of the examples with IDs `qa_ids`."""
+    qa_ids = np.asarray(qa_ids, dtype=np.int64)
+    rows = np.searchsorted(self.ids, qa_ids)
+    rows = np.minimum(rows, len(self.ids) - 1)
+    if not np.array_equal(self.ids[rows], qa_ids):
+      raise KeyError('Unknown example IDs in {}'.format(qa_ids))
+
+    return rows
+
+  def uuids(self, rows):
+    """Get the UUIDs of the examples at `rows`."""
+    rows = np.asarray(rows)
+    starts, ends = self.uuid_offsets[rows], self.uuid_offsets[rows + 1]
+    return [self.uuid_text[s:e] for s, e in zip(starts, ends)]
+
+  def answer_spans(self, rows, y_starts, y_ends):
+    """Get the text of the token spans `[y_start, y_end]` of the contexts at
+        `rows`, along with their character offsets within each context.
+        """
+    ctx_idxs = self.ctx_idxs[rows]
+    token_offsets = self.span_offsets[ctx_idxs]
+    char_offsets = self.context_offsets[ctx_idxs]
+    starts = self.spans[token_offsets + np.asarray(y_starts), 0]
+    ends = self.spans[token_offsets + np.asarray(y_ends), 1]
+    texts = [
+        self.context_text[s:e]
+        for s, e in zip(starts + char_offsets, ends + char_offsets)
+    ]
+
+    return texts, starts, ends
+
+  @property
+  def gold_answers(self):
+    """Gold answers prepared for `eval_dicts`."""
+    if self._gold_answers is None:
+      self._gold_answers = prepare_gold_answers(self)
+    return self._gold_answers
+
+  def __getitem__(self, qa_id):
+    row = self.rows([int(qa_id)])[0]
+    ctx_idx = self.ctx_idxs[row]
+    context = self.context_text[self.context_offsets[ctx_idx]:
+                                self.context_offsets[ctx_idx + 1]]
+    spans = self.spans[self.span_offsets[ctx_idx]:
+                       self.span_offsets[ctx_idx + 1]].tolist()
+    question = self.question_text[self.question_offsets[row]:
+                                  self.question_offsets[row + 1]]
+    answers = [
+        self.answer_text[self.answer_offsets[i]:self.answer_offsets[i + 1]]
+        for i in range(self.answer_groups[row], self.answer_groups[row + 1])
+    ]
+
+    return {
+        'context': context,
+        'question': question,
+        'spans': spans,
+        'answers': answers,
+        'uuid': self.uuids([row])[0]
+    }
+
+  def __contains__(self, qa_id):
+    row = np.searchsorted(self.ids, int(qa_id))
+    return row < len(self.ids) and self.ids[row] == int(qa_id)
+
+  def __len__(self):
+    return len(self.ids)
+
+  def keys(self):
+    return [str(id_) for id_ in self.ids]
+
+  def items(self):
+    for key in self.keys():
+      yield key, self[key]
+
+
+_EVAL_STORES = {}
+
+
+def load_eval_store(path, eval_file=None):
+  """Load an eval store, at most once per process.
+
+    Args:
+        path (str): Path to the store written by `save_eval_store`.
+        eval_file (str): Eval JSON file to build the store from if `path`
+            does not exist (e.g., data pre-processed by an older setup.py).
+
+    Returns:
+        eval_store (EvalStore): Eval info for the split.
+    """
+  if path not in _EVAL_STORES:
+    if os.path.exists(path) or eval_file is None:
+      with np.load(path) as npz:
+        arrays = {name: npz[name] for name in npz.files}
+    else:
+      with open(eval_file, 'r') as fh:
+        eval_dict = json.load(fh)
+      buffer = io.BytesIO()
+      save_eval_store(buffer, eval_dict)
+      buffer.seek(0)
+      with np.load(buffer) as npz:
+        arrays = {name: npz[name] for name in npz.files}
+    _EVAL_STORES[path] = EvalStore(arrays)
+
+  return _EVAL_STORES[path]
+
+
+def visualize(tbx, pred_dict, eval_dict, step, split, num_visuals):
   """Visualize text examples to TensorBoard.
 
     Args:
         tbx (tensorboardX.SummaryWriter): Summary writer.
         pred_dict (dict): dict of predictions of the form id -> pred.
-        eval_path (str): Path to eval JSON file.
+        eval_dict (EvalStore): Eval info for the split (or an eval dict).
         step (int): Number of examples seen so far during training.
         split (str): Name of data split being visualized.
         num_visuals (int): Number of visuals to select at random from preds.
@@ -415,8 +1414,6 @@ def visualize(tbx, pred_dict, eval_path, step, split, num_visuals):
   visual_ids = np.random.choice(
       list(pred_dict), size=num_visuals, replace=False)
 
-  with open(eval_path, 'r') as eval_file:
-    eval_dict = json.load(eval_file)
   for i, id_ in enumerate(visual_ids):
     pred = pred_dict[id_] or 'N/A'
     example = eval_dict[str(id_)]
@@ -460,6 +1457,150 @@ def save_preds(preds, save_dir, file_name='predictions.csv'):
   return save_path
 
 
+class PredictionWriter:
+  """Stream predictions to disk batch by batch, with resumable progress.
+
+    Each batch of predictions is appended to `preds.csv` in `save_dir`, then
+    progress is recorded in `progress.json`. The progress file holds the
+    number of examples done, the size of `preds.csv` at that point, a
+    reservoir sample of predictions for visualization, and any state the
+    caller passes in (e.g., running metrics). When resuming, `preds.csv` is
+    truncated back to the last recorded batch and the caller continues after
+    `num_examples` examples. `finish` writes the submission CSV sorted by
+    UUID using an external merge sort, so memory stays bounded.
+
+    Args:
+        save_dir (str): Directory for the predictions and progress files.
+        resume (bool): Continue from the progress saved in `save_dir`.
+        num_samples (int): Size of the reservoir sample of predictions.
+        log (logging.Logger): Optional logger for printing information.
+    """
+
+  def __init__(self, save_dir, resume=False, num_samples=0, log=None):
+    self.preds_path = os.path.join(save_dir, 'preds.csv')
+    self.progress_path = os.path.join(save_dir, 'progress.json')
+    self.num_samples = num_samples
+    self.log = log
+    self.num_examples = 0
+    self.num_seen = 0
+    self.samples = []  # Reservoir sample of [id, prediction] pairs
+    self.state = None
+    offset = 0
+    if resume and os.path.exists(self.progress_path):
+      with open(self.progress_path, 'r') as fh:
+        progress = json.load(fh)
+      self.num_examples = progress['num_examples']
+      self.num_seen = progress['num_seen']
+      self.samples = progress['samples']
+      self.state = progress['state']
+      offset = progress['offset']
+      self._print('Resuming after {} examples...'.format(self.num_examples))
+
+    # Drop predictions written after the last recorded batch. Binary mode,
+    # so that offsets from `tell` are byte positions
+    self.preds_fh = open(self.preds_path, 'a+b')
+    self.preds_fh.truncate(offset)
+    self.preds_fh.seek(offset)
+
+  def _print(self, message):
+    if self.log is not None:
+      self.log.info(message)
+
+  def write(self, idx2pred, uuid2pred, state=None):
+    """Append a batch of predictions and record progress.
+
+        Args:
+            idx2pred (dict): Predictions keyed by example ID.
+            uuid2pred (dict): Predictions keyed by UUID, for submission.
+            state (dict): JSON-serializable state to restore on resume.
+        """
+    rows = io.StringIO(newline='')
+    csv.writer(rows).writerows(uuid2pred.items())
+    self.preds_fh.write(rows.getvalue().encode('utf-8'))
+    self.preds_fh.flush()
+
+    for item in idx2pred.items():
+      self.num_seen += 1
+      if len(self.samples) < self.num_samples:
+        self.samples.append(list(item))
+      else:
+        i = random.randrange(self.num_seen)
+        if i < self.num_samples:
+          self.samples[i] = list(item)
+    self.num_examples += len(idx2pred)
+    self.state = state
+
+    progress = {
+        'num_examples': self.num_examples,
+        'offset': self.preds_fh.tell(),
+        'num_seen': self.num_seen,
+        'samples': self.samples,
+        'state': state
+    }
+    tmp_path = self.progress_path + '.tmp'
+    with open(tmp_path, 'w') as fh:
+      json.dump(progress, fh)
+    os.replace(tmp_path, self.progress_path)
+
+  def sample_dict(self):
+    """Get the reservoir sample of predictions as a dict."""
+    return dict(self.samples)
+
+  def close(self):
+    """Close the predictions file. Progress stays on disk for resuming."""
+    self.preds_fh.close()
+
+  def finish(self, sub_path, chunk_size=100000):
+    """Write all predictions to a submission CSV sorted by UUID.
+
+        Args:
+            sub_path (str): Path of the submission CSV.
+            chunk_size (int): Number of predictions to sort in memory at once.
+        """
+    self.close()
+    merge_predictions([self.preds_path], sub_path, chunk_size)
+
+
+def merge_predictions(preds_paths, sub_path, chunk_size=100000):
+  """Merge predictions files written by `PredictionWriter` into one
+    submission CSV sorted by UUID, using an external merge sort.
+
+    Args:
+        preds_paths (list): Paths of the predictions files.
+        sub_path (str): Path of the submission CSV.
+        chunk_size (int): Number of predictions to sort in memory at once.
+    """
+  # Sort chunks into temporary runs
+  run_paths = []
+  for preds_path in preds_paths:
+    with open(preds_path, 'r', newline='', encoding='utf-8') as fh:
+      reader = csv.reader(fh)
+      while True:
+        chunk = sorted(itertools.islice(reader, chunk_size),
+                       key=lambda row: row[0])
+        if not chunk:
+          break
+        run_path = '{}.run{}'.format(preds_path, len(run_paths))
+        with open(run_path, 'w', newline='', encoding='utf-8') as run_fh:
+          csv.writer(run_fh).writerows(chunk)
+        run_paths.append(run_path)
+
+  # Merge runs into the submission file
+  run_fhs = [open(path, 'r', newline='', encoding='utf-8')
+             for path in run_paths]
+  try:
+    with open(sub_path, 'w', newline='', encoding='utf-8') as csv_fh:
+      csv_writer = csv.writer(csv_fh, delimiter=',')
+      csv_writer.writerow(['Id', 'Predicted'])
+      csv_writer.writerows(
+          heapq.merge(*[csv.reader(run_fh) for run_fh in run_fhs],
+                      key=lambda row: row[0]))
+  finally:
+    for run_fh, path in zip(run_fhs, run_paths):
+      run_fh.close()
+      os.remove(path)
+
+
 def get_save_dir(base_dir, name, training, id_max=100):
   """Get a unique save directory by appending the smallest positive integer
     `id < id_max` that is not already taken (i.e., no dir exists with that id).
@@ -559,12 +1700,30 @@ def torch_from_json(path, dtype=torch.float32):
   return tensor
 
 
+def tensor_digest(tensor):
+  """Get a SHA-1 hex digest of the contents of a tensor.
+
+    Args:
+        tensor (torch.Tensor): Tensor to hash.
+
+    Returns:
+        digest (str): Hex digest of the tensor's bytes.
+    """
+  array = tensor.detach().cpu().contiguous().numpy()
+  return hashlib.sha1(array.reshape(-1).view(np.uint8)).hexdigest()
+
+
+@profiled('util.discretize')
 def discretize(p_start, p_end, max_len=15, no_answer=False):
   """Discretize soft predictions to get start and end indices.
 
     Choose the pair `(i, j)` of indices that maximizes `p1[i] * p2[j]`
     subject to `i <= j` and `j - i + 1 <= max_len`.
 
+    Only the band of legal pairs is searched, using sliding-window maxima
+    over `p_start` and `p_end`, so time and memory grow linearly with the
+    context length rather than quadratically.
+
     Args:
         p_start (torch.Tensor): Soft predictions for start index.
             Shape (batch_size, context_len).
@@ -586,28 +1745,25 @@ def discretize(p_start, p_end, max_len=15, no_answer=False):
           or p_end.min() < 0 or p_end.max() > 1:
     raise ValueError('Expected p_start and p_end to have values in [0, 1]')
 
-  # Compute pairwise probabilities
-  p_start = p_start.unsqueeze(dim=2)
-  p_end = p_end.unsqueeze(dim=1)
-  p_joint = torch.matmul(p_start, p_end)  # (batch_size, c_len, c_len)
-
-  # Restrict to pairs (i, j) such that i <= j <= i + max_len - 1
-  c_len, device = p_start.size(1), p_start.device
-  is_legal_pair = torch.triu(torch.ones((c_len, c_len), device=device))
-  is_legal_pair -= torch.triu(
-      torch.ones((c_len, c_len), device=device), diagonal=max_len)
   if no_answer:
-    # Index 0 is no-answer
-    p_no_answer = p_joint[:, 0, 0].clone()
-    is_legal_pair[0, :] = 0
-    is_legal_pair[:, 0] = 0
-  else:
-    p_no_answer = None
-  p_joint *= is_legal_pair
+    # Index 0 is no-answer, and may not be part of any other span
+    p_no_answer = p_start[:, 0] * p_end[:, 0]
+    p_start = torch.cat((torch.zeros_like(p_start[:, :1]), p_start[:, 1:]), 1)
+    p_end = torch.cat((torch.zeros_like(p_end[:, :1]), p_end[:, 1:]), 1)
+
+  # Only pairs (i, j) such that i <= j <= i + max_len - 1 are legal, so the
+  # best pair starting at i uses the max of p_end over the window
+  # [i, i + max_len - 1], and the best pair ending at j uses the max of
+  # p_start over the window [j - max_len + 1, j]. All values are
+  # non-negative, so padding with zeros never changes a maximum.
+  max_end = F.max_pool1d(
+      F.pad(p_end.unsqueeze(1), (0, max_len - 1)), max_len, stride=1)
+  max_start = F.max_pool1d(
+      F.pad(p_start.unsqueeze(1), (max_len - 1, 0)), max_len, stride=1)
+  max_in_row = p_start * max_end.squeeze(1)  # (batch_size, c_len)
+  max_in_col = p_end * max_start.squeeze(1)  # (batch_size, c_len)
 
   # Take pair (i, j) that maximizes p_joint
-  max_in_row, _ = torch.max(p_joint, dim=2)
-  max_in_col, _ = torch.max(p_joint, dim=1)
   start_idxs = torch.argmax(max_in_row, dim=-1)
   end_idxs = torch.argmax(max_in_col, dim=-1)
 
@@ -620,37 +1776,149 @@ def discretize(p_start, p_end, max_len=15, no_answer=False):
   return start_idxs, end_idxs
 
 
-def convert_tokens(eval_dict, qa_id, y_start_list, y_end_list, no_answer):
+def discretize_topk(p_start, p_end, k=5, max_len=15, no_answer=False):
+  """Get the `k` most likely legal spans from soft predictions.
+
+    A span `(i, j)` is legal if `i <= j` and `j - i + 1 <= max_len`, and its
+    probability is `p1[i] * p2[j]`. Only the band of legal spans is scored,
+    giving a (batch_size, context_len, max_len) tensor of joint probabilities.
+
+    Args:
+        p_start (torch.Tensor): Soft predictions for start index.
+            Shape (batch_size, context_len).
+        p_end (torch.Tensor): Soft predictions for end index.
+            Shape (batch_size, context_len).
+        k (int): Number of spans to return per example.
+        max_len (int): Maximum length of a span.
+        no_answer (bool): Treat 0-index as the no-answer prediction. The span
+            `(0, 0)` with probability `p1[0] * p2[0]` is ranked along with the
+            other spans, and no other span may include index 0.
+
+    Returns:
+        start_idxs (torch.Tensor): Start index of each span, in decreasing
+            order of probability. Shape (batch_size, k). Entries are -1 when
+            there are fewer than `k` legal spans.
+        end_idxs (torch.Tensor): End index of each span. Shape (batch_size, k).
+        probs (torch.Tensor): Joint probability of each span.
+            Shape (batch_size, k).
+        p_no_answer (torch.Tensor): Probability of no-answer.
+            Shape (batch_size,). None unless `no_answer` is set.
+    """
+  if p_start.min() < 0 or p_start.max() > 1 \
+          or p_end.min() < 0 or p_end.max() > 1:
+    raise ValueError('Expected p_start and p_end to have values in [0, 1]')
+
+  # p_joint[b, i, l] = p_start[b, i] * p_end[b, i + l]
+  c_len, device = p_start.size(1), p_start.device
+  p_end_band = F.pad(p_end, (0, max_len - 1)).unfold(1, max_len, 1)
+  p_joint = p_start.unsqueeze(2) * p_end_band  # (batch_size, c_len, max_len)
+
+  # Mark pairs that run past the end of the context as illegal
+  offsets = torch.arange(max_len, device=device)
+  is_legal = torch.arange(c_len, device=device).unsqueeze(1) + offsets < c_len
+  if no_answer:
+    # Index 0 is no-answer, and may only be predicted on its own
+    p_no_answer = p_joint[:, 0, 0].clone()
+    is_legal[0, 1:] = 0
+  else:
+    p_no_answer = None
+  p_joint = p_joint.masked_fill(~is_legal, -1.)
+
+  # Take the k pairs with the highest joint probability
+  k = min(k, c_len * max_len)
+  probs, flat_idxs = torch.topk(p_joint.view(p_joint.size(0), -1), k, dim=-1)
+  start_idxs = flat_idxs // max_len
+  end_idxs = start_idxs + flat_idxs % max_len
+
+  is_missing = probs < 0
+  start_idxs[is_missing] = -1
+  end_idxs[is_missing] = -1
+  probs[is_missing] = 0.
+
+  return start_idxs, end_idxs, probs, p_no_answer
+
+
+def convert_tokens(eval_dict,
+                   qa_id,
+                   y_start_list,
+                   y_end_list,
+                   no_answer,
+                   probs_list=None):
   """Convert predictions to tokens from the context.
 
     Args:
-        eval_dict (dict): Dictionary with eval info for the dataset. This is
-            used to perform the mapping from IDs and indices to actual text.
+        eval_dict (EvalStore): Eval info for the dataset (or the equivalent
+            dict loaded from an eval JSON file). This is used to perform the
+            mapping from IDs and indices to actual text.
         qa_id (int): List of QA example IDs.
         y_start_list (list): List of start predictions.
         y_end_list (list): List of end predictions.
         no_answer (bool): Questions can have no answer. E.g., SQuAD 2.0.
+        probs_list (list): Optional list of span probabilities. If given,
+            each entry of `y_start_list`, `y_end_list` and `probs_list` is a
+            ranked list of spans for one example (see `discretize_topk`).
 
     Returns:
         pred_dict (dict): Dictionary index IDs -> predicted answer text.
         sub_dict (dict): Dictionary UUIDs -> predicted answer text (submission).
+            If `probs_list` is given, both dictionaries instead map to ranked
+            lists of dicts with keys 'text', 'start', 'end' and 'prob', where
+            'start' and 'end' are character offsets in the context (-1 for
+            no-answer).
     """
   pred_dict = {}
   sub_dict = {}
-  for qid, y_start, y_end in zip(qa_id, y_start_list, y_end_list):
-    context = eval_dict[str(qid)]["context"]
-    spans = eval_dict[str(qid)]["spans"]
-    uuid = eval_dict[str(qid)]["uuid"]
+
+  def get_answer(example, y_start, y_end):
     if no_answer and (y_start == 0 or y_end == 0):
-      pred_dict[str(qid)] = ''
-      sub_dict[uuid] = ''
+      return '', -1, -1
+    if no_answer:
+      y_start, y_end = y_start - 1, y_end - 1
+    start_idx = example["spans"][y_start][0]
+    end_idx = example["spans"][y_end][1]
+    return example["context"][start_idx:end_idx], start_idx, end_idx
+
+  if probs_list is None and isinstance(eval_dict, EvalStore):
+    # Look up the whole batch at once
+    rows = eval_dict.rows(qa_id)
+    y_starts, y_ends = np.asarray(y_start_list), np.asarray(y_end_list)
+    if no_answer:
+      is_empty = (y_starts == 0) | (y_ends == 0)
+      y_starts = np.maximum(y_starts - 1, 0)
+      y_ends = np.maximum(y_ends - 1, 0)
     else:
-      if no_answer:
-        y_start, y_end = y_start - 1, y_end - 1
-      start_idx = spans[y_start][0]
-      end_idx = spans[y_end][1]
-      pred_dict[str(qid)] = context[start_idx:end_idx]
-      sub_dict[uuid] = context[start_idx:end_idx]
+      is_empty = np.zeros(len(rows), dtype=bool)
+    texts, _, _ = eval_dict.answer_spans(rows, y_starts, y_ends)
+    texts = ['' if empty else text for text, empty in zip(texts, is_empty)]
+    pred_dict = {str(qid): text for qid, text in zip(qa_id, texts)}
+    sub_dict = dict(zip(eval_dict.uuids(rows), texts))
+    return pred_dict, sub_dict
+
+  if probs_list is None:
+    for qid, y_start, y_end in zip(qa_id, y_start_list, y_end_list):
+      example = eval_dict[str(qid)]
+      text, _, _ = get_answer(example, y_start, y_end)
+      pred_dict[str(qid)] = text
+      sub_dict[example["uuid"]] = text
+    return pred_dict, sub_dict
+
+  for qid, y_starts, y_ends, probs in zip(qa_id, y_start_list, y_end_list,
+                                          probs_list):
+    example = eval_dict[str(qid)]
+    answers = []
+    for y_start, y_end, prob in zip(y_starts, y_ends, probs):
+      if y_start < 0:
+        # Fewer legal spans than requested
+        break
+      text, start_idx, end_idx = get_answer(example, y_start, y_end)
+      answers.append({
+          'text': text,
+          'start': start_idx,
+          'end': end_idx,
+          'prob': prob
+      })
+    pred_dict[str(qid)] = answers
+    sub_dict[example["uuid"]] = answers
   return pred_dict, sub_dict
 
 
@@ -664,34 +1932,124 @@ def metric_max_over_ground_truths(metric_fn, prediction, ground_truths):
   return max(scores_for_ground_truths)
 
 
-def eval_dicts(gold_dict, pred_dict, no_answer: bool):
+def prepare_gold_answers(gold_dict):
+  """Normalize and tokenize every gold answer once, for use by `eval_dicts`.
+
+    Args:
+        gold_dict: Dictionary mapping ids to eval info with 'answers'.
+
+    Returns:
+        Dictionary mapping ids to a tuple (is_answerable, answers), where
+        answers is a list of (normalized text, token Counter, number of tokens)
+        for each ground truth. Unanswerable questions get a single empty answer.
+    """
+  gold_answers = {}
+  for key, example in gold_dict.items():
+    ground_truths = example['answers'] or ['']
+    answers = []
+    for ground_truth in ground_truths:
+      normalized = normalize_answer(ground_truth)
+      tokens = normalized.split()
+      answers.append((normalized, Counter(tokens), len(tokens)))
+    gold_answers[key] = (bool(example['answers']), answers)
+
+  return gold_answers
+
+
+def eval_dicts(gold_dict, pred_dict, no_answer: bool, gold_answers=None):
   """Computes the evaluation metrics. 
 
     Args:
         gold_dict: Dictionary mapping ids to
         pred_dict: A dictionary mapping each sample id to the predicted answer.
         no_answer: If answer vs no-answer accuracy should be computed. 
+        gold_answers: Gold answers from `prepare_gold_answers`. Pass these in
+            when evaluating repeatedly against the same `gold_dict`.
 
     Returns:
         Dictionary containing 'EM' and 'F1', as well as 'AvNA' if 'no_answer'
         is specified. 
     """
-  avna = f1 = em = total = 0
-  for key, value in pred_dict.items():
-    total += 1
-    ground_truths = gold_dict[key]['answers']
-    prediction = value
-    em += metric_max_over_ground_truths(compute_em, prediction, ground_truths)
-    f1 += metric_max_over_ground_truths(compute_f1, prediction, ground_truths)
-    if no_answer:
-      avna += compute_avna(prediction, ground_truths)
+  if gold_answers is None:
+    gold_answers = prepare_gold_answers(
+        {key: gold_dict[key] for key in pred_dict})
+  meter = EvalMeter(gold_answers, no_answer)
+  meter.update(pred_dict)
 
-  eval_dict = {'EM': 100. * em / total, 'F1': 100. * f1 / total}
+  return meter.results()
 
-  if no_answer:
-    eval_dict['AvNA'] = 100. * avna / total
 
-  return eval_dict
+class EvalMeter:
+  """Accumulate EM, F1 and AvNA over batches of predictions.
+
+    Gives the same results as `eval_dicts` on all predictions at once,
+    without keeping the predictions around.
+
+    Args:
+        gold_answers (dict): Gold answers from `prepare_gold_answers`.
+        no_answer (bool): Whether to compute answer vs. no-answer accuracy.
+    """
+
+  def __init__(self, gold_answers, no_answer):
+    self.gold_answers = gold_answers
+    self.no_answer = no_answer
+    self.em = self.f1 = self.avna = 0.
+    self.total = 0
+
+  def update(self, pred_dict):
+    """Add predictions in a dict mapping IDs to predicted answers."""
+    for key, prediction in pred_dict.items():
+      self.total += 1
+      is_answerable, answers = self.gold_answers[key]
+      normalized = normalize_answer(prediction)
+      tokens = normalized.split()
+      counter, num_tokens = Counter(tokens), len(tokens)
+      self.em += max(int(gold == normalized) for gold, _, _ in answers)
+      self.f1 += max(
+          f1_from_counters(gold_counter, gold_num_tokens, counter, num_tokens)
+          for _, gold_counter, gold_num_tokens in answers)
+      if self.no_answer:
+        self.avna += float(bool(prediction) == is_answerable)
+
+  def results(self):
+    """Get a dict with 'EM' and 'F1', and 'AvNA' if `no_answer` is set."""
+    total = max(self.total, 1)  # All zeros before any predictions
+    eval_dict = {'EM': 100. * self.em / total, 'F1': 100. * self.f1 / total}
+
+    if self.no_answer:
+      eval_dict['AvNA'] = 100. * self.avna / total
+
+    return eval_dict
+
+  def state_dict(self):
+    return {
+        'em': self.em,
+        'f1': self.f1,
+        'avna': self.avna,
+        'total': self.total
+    }
+
+  def load_state_dict(self, state_dict):
+    self.em = state_dict['em']
+    self.f1 = state_dict['f1']
+    self.avna = state_dict['avna']
+    self.total = state_dict['total']
+
+
+def f1_from_counters(gold_counter, gold_num_tokens, pred_counter,
+                     pred_num_tokens):
+  """Same as `compute_f1`, but on pre-tokenized answers."""
+  if gold_num_tokens == 0 or pred_num_tokens == 0:
+    # If either is no-answer, then F1 is 1 if they agree, 0 otherwise
+    return int(gold_num_tokens == pred_num_tokens)
+  common = gold_counter & pred_counter
+  num_same = sum(common.values())
+  if num_same == 0:
+    return 0
+  precision = 1.0 * num_same / pred_num_tokens
+  recall = 1.0 * num_same / gold_num_tokens
+  f1 = (2 * precision * recall) / (precision + recall)
+  return f1
 
 
 def compute_avna(prediction, ground_truths):
@@ -701,19 +2059,21 @@ def compute_avna(prediction, ground_truths):
 
 # All methods below this line are from the official SQuAD 2.0 eval script
 # https://worksheets.codalab.org/rest/bundles/0x6b567e1cf2e041ec80d7098f031c5c9e/contents/blob/
+_ARTICLES_REGEX = re.compile(r'\b(a|an|the)\b', re.UNICODE)
+_PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+
 def normalize_answer(s):
   """Convert to lowercase and remove punctuation, articles and extra whitespace."""
 
   def remove_articles(text):
-    regex = re.compile(r'\b(a|an|the)\b', re.UNICODE)
-    return re.sub(regex, ' ', text)
+    return _ARTICLES_REGEX.sub(' ', text)
 
   def white_space_fix(text):
     return ' '.join(text.split())
 
   def remove_punc(text):
-    exclude = set(string.punctuation)
-    return ''.join(ch for ch in text if ch not in exclude)
+    return text.translate(_PUNCTUATION_TABLE)
 
   def lower(text):
     return text.lower()